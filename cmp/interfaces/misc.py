@@ -12,6 +12,8 @@ from nipype.interfaces.base import traits, isdefined, CommandLine, CommandLineIn
 
 import nibabel as nib
 
+from cmtklib.util import as_labels
+
 class ExtractPVEsFrom5TTInputSpec(BaseInterfaceInputSpec):
     in_5tt = File(desc="Input 5TT (4D) image",exists=True,mandatory=True)
     ref_image = File(desc="Reference 3D image to be used to save 3D PVE volumes",exists=True,mandatory=True)
@@ -300,59 +302,22 @@ class UpdateGMWMInterfaceSeeding(BaseInterface):
 
 
         roi_img = nib.load(roi_fname)
-        roi_data = roi_img.get_data()
+        roi_data = as_labels(roi_img.get_data())
 
         new_gmwmi_data = gmwmi_data.copy()
 
         if roi_data.max() > 83:
 
             # Thalamic nuclei
-            new_gmwmi_data[roi_data==35] = maxv
-            new_gmwmi_data[roi_data==36] = maxv
-            new_gmwmi_data[roi_data==37] = maxv
-            new_gmwmi_data[roi_data==38] = maxv
-            new_gmwmi_data[roi_data==39] = maxv
-            new_gmwmi_data[roi_data==40] = maxv
-            new_gmwmi_data[roi_data==41] = maxv
-            new_gmwmi_data[roi_data==96] = maxv
-            new_gmwmi_data[roi_data==97] = maxv
-            new_gmwmi_data[roi_data==98] = maxv
-            new_gmwmi_data[roi_data==99] = maxv
-            new_gmwmi_data[roi_data==100] = maxv
-            new_gmwmi_data[roi_data==101] = maxv
-            new_gmwmi_data[roi_data==102] = maxv
+            labels = [35, 36, 37, 38, 39, 40, 41, 96, 97, 98, 99, 100, 101, 102]
 
             # Hippocampal subfields
-            new_gmwmi_data[roi_data==48] = maxv
-            new_gmwmi_data[roi_data==49] = maxv
-            new_gmwmi_data[roi_data==50] = maxv
-            new_gmwmi_data[roi_data==51] = maxv
-            new_gmwmi_data[roi_data==52] = maxv
-            new_gmwmi_data[roi_data==53] = maxv
-            new_gmwmi_data[roi_data==54] = maxv
-            new_gmwmi_data[roi_data==55] = maxv
-            new_gmwmi_data[roi_data==56] = maxv
-            new_gmwmi_data[roi_data==57] = maxv
-            new_gmwmi_data[roi_data==58] = maxv
-            new_gmwmi_data[roi_data==59] = maxv
-            new_gmwmi_data[roi_data==109] = maxv
-            new_gmwmi_data[roi_data==110] = maxv
-            new_gmwmi_data[roi_data==111] = maxv
-            new_gmwmi_data[roi_data==112] = maxv
-            new_gmwmi_data[roi_data==113] = maxv
-            new_gmwmi_data[roi_data==114] = maxv
-            new_gmwmi_data[roi_data==115] = maxv
-            new_gmwmi_data[roi_data==116] = maxv
-            new_gmwmi_data[roi_data==117] = maxv
-            new_gmwmi_data[roi_data==118] = maxv
-            new_gmwmi_data[roi_data==119] = maxv
-            new_gmwmi_data[roi_data==120] = maxv
+            labels += range(48, 59+1) + range(109, 120+1)
 
             # Brain stem
-            new_gmwmi_data[roi_data==123] = maxv
-            new_gmwmi_data[roi_data==124] = maxv
-            new_gmwmi_data[roi_data==125] = maxv
-            new_gmwmi_data[roi_data==126] = maxv
+            labels += [123, 124, 125, 126]
+
+            new_gmwmi_data[np.isin(roi_data, labels)] = maxv
 
         new_gmwmi_img = nib.Nifti1Pair(new_gmwmi_data, gmwmi_img.affine)
         nib.save(new_gmwmi_img, self.inputs.out_gmwmi_file)
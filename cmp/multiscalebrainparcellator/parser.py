@@ -19,10 +19,11 @@ def get():
                         'this folder should be prepopulated with the results of the'
                         'participant level analysis.')
     p.add_argument('analysis_level', help='Level of the analysis that will be performed. '
-                        'Note that only participant level analysis is available.'
                         'Multiple participant level analyses can be run independently '
-                        '(in parallel) using the same output_dir.',
-                        choices=['participant'])
+                        '(in parallel) using the same output_dir. The group level analysis '
+                        'aggregates the parcel volumes of all participants in one '
+                        'participant x parcel matrix per scale.',
+                        choices=['participant', 'group'])
     p.add_argument('--participant_label', help='The label(s) of the participant(s) '
                        'that should be analyzed. The label '
                        'corresponds to sub-<participant_label> from the BIDS spec '
@@ -34,9 +35,11 @@ def get():
     p.add_argument('--multiproc_number_of_cores', help='The number of cores to be used by '
                    'the MultiProc plugin of Nipype (One core used by default).')
     p.add_argument('--number_of_participants_processed_in_parallel', help='The number of subjects '
-                   'to be processed in parallel (One core used by default).')
+                   'to be processed in parallel (One core used by default). At the group level, '
+                   'the number of processes reading the participant outputs.')
     p.add_argument('--fs_number_of_cores', help='The number of cores to be used by '
-                   'Freesurfer (One core used by default).')
+                   'Freesurfer and by the ANTs commands of the thalamic nuclei parcellation '
+                   '(One core used by default).')
 
     p.add_argument('--fs_license', help='Path to Freesurfer license. ')
 
@@ -347,6 +347,13 @@ class AnatomicalPipeline(cmp_common.Pipeline):
                                             ('roi_stats_scale3.tsv',self.subject+'_label-L2018_desc-scale3_stats.tsv'),
                                             ('roi_stats_scale4.tsv',self.subject+'_label-L2018_desc-scale4_stats.tsv'),
                                             ('roi_stats_scale5.tsv',self.subject+'_label-L2018_desc-scale5_stats.tsv'),
+                                            ('roi_nesting.tsv',self.subject+'_label-L2018_nesting.tsv'),
+                                            ('roi_summary.tsv',self.subject+'_label-L2018_summary.tsv'),
+                                            ('T1_class-thalamus_probtissue_stats.tsv',self.subject+'_label-thalamus_stats.tsv'),
+                                            ('roi_nesting_scale2.tsv',self.subject+'_label-L2018_desc-scale2_nesting.tsv'),
+                                            ('roi_nesting_scale3.tsv',self.subject+'_label-L2018_desc-scale3_nesting.tsv'),
+                                            ('roi_nesting_scale4.tsv',self.subject+'_label-L2018_desc-scale4_nesting.tsv'),
+                                            ('roi_nesting_scale5.tsv',self.subject+'_label-L2018_desc-scale5_nesting.tsv'),
                                             ('ROIv_HR_th_scale1.nii.gz',self.subject+'_label-L2018_desc-scale1_atlas.nii.gz'),
                                             ('ROIv_HR_th_scale2.nii.gz',self.subject+'_label-L2018_desc-scale2_atlas.nii.gz'),
                                             ('ROIv_HR_th_scale3.nii.gz',self.subject+'_label-L2018_desc-scale3_atlas.nii.gz'),
@@ -367,6 +374,11 @@ class AnatomicalPipeline(cmp_common.Pipeline):
                                             ('ROIv_HR_th_scale3_FreeSurferColorLUT.txt',self.subject+'_label-L2018_desc-scale3_atlas_FreeSurferColorLUT.txt'),
                                             ('ROIv_HR_th_scale4_FreeSurferColorLUT.txt',self.subject+'_label-L2018_desc-scale4_atlas_FreeSurferColorLUT.txt'),
                                             ('ROIv_HR_th_scale5_FreeSurferColorLUT.txt',self.subject+'_label-L2018_desc-scale5_atlas_FreeSurferColorLUT.txt'),
+                                            ('ROIv_HR_th_scale1_nodes.tsv',self.subject+'_label-L2018_desc-scale1_atlas.tsv'),
+                                            ('ROIv_HR_th_scale2_nodes.tsv',self.subject+'_label-L2018_desc-scale2_atlas.tsv'),
+                                            ('ROIv_HR_th_scale3_nodes.tsv',self.subject+'_label-L2018_desc-scale3_atlas.tsv'),
+                                            ('ROIv_HR_th_scale4_nodes.tsv',self.subject+'_label-L2018_desc-scale4_atlas.tsv'),
+                                            ('ROIv_HR_th_scale5_nodes.tsv',self.subject+'_label-L2018_desc-scale5_atlas.tsv'),
                                             ('ROIv_HR_th_scale33.nii.gz',self.subject+'_label-L2018_desc-scale1_atlas.nii.gz'),
                                             ('ROIv_HR_th_scale60.nii.gz',self.subject+'_label-L2018_desc-scale2_atlas.nii.gz'),
                                             ('ROIv_HR_th_scale125.nii.gz',self.subject+'_label-L2018_desc-scale3_atlas.nii.gz'),
@@ -400,7 +412,7 @@ class AnatomicalPipeline(cmp_common.Pipeline):
         anat_flow = pe.Workflow(name='anatomical_pipeline', base_dir=nipype_deriv_subject_directory)
         anat_inputnode = pe.Node(interface=util.IdentityInterface(fields=["T1"]),name="inputnode")
         anat_outputnode = pe.Node(interface=util.IdentityInterface(fields=["subjects_dir","subject_id","T1","aseg","aparc_aseg","brain","brain_mask","wm_mask_file", "gm_mask_file", "wm_eroded","brain_eroded","csf_eroded",
-            "roi_volumes","roi_volumes_stats","parcellation_scheme","atlas_info","roi_colorLUTs", "roi_graphMLs"]),name="outputnode")
+            "roi_volumes","roi_volumes_stats","roi_nesting_tables","roi_summary","thalamus_nuclei_stats","parcellation_scheme","atlas_info","roi_colorLUTs", "roi_graphMLs", "roi_node_tables"]),name="outputnode")
         
         anat_flow.add_nodes([anat_inputnode,anat_outputnode])
 
@@ -425,7 +437,11 @@ class AnatomicalPipeline(cmp_common.Pipeline):
                         ])
 
         if self.stages['Parcellation'].enabled:
+            # The registration of the thalamus template is kept out of the FreeSurfer subject directory,
+            # which recon-all creates when it starts
+            self.stages['Parcellation'].config.thalamus_registration_directory = os.path.join(nipype_deriv_subject_directory,'thalamus_registration')
             parc_flow = self.create_stage_flow("Parcellation")
+            anat_flow.connect([(anat_inputnode,parc_flow, [('T1','inputnode.T1')])])
             if self.stages['Segmentation'].config.seg_tool == "Freesurfer":
                 anat_flow.connect([(seg_flow,parc_flow, [('outputnode.subjects_dir','inputnode.subjects_dir'),
                                                            ('outputnode.subject_id','inputnode.subject_id')]),
@@ -438,7 +454,11 @@ class AnatomicalPipeline(cmp_common.Pipeline):
                                                                ("outputnode.roi_volumes","roi_volumes"),
                                                                ("outputnode.roi_colorLUTs","roi_colorLUTs"),
                                                                ("outputnode.roi_graphMLs","roi_graphMLs"),
+                                                               ("outputnode.roi_node_tables","roi_node_tables"),
                                                                ("outputnode.roi_volumes_stats","roi_volumes_stats"),
+                                                               ("outputnode.roi_nesting_tables","roi_nesting_tables"),
+                                                               ("outputnode.roi_summary","roi_summary"),
+                                                               ("outputnode.thalamus_nuclei_stats","thalamus_nuclei_stats"),
                                                                ("outputnode.wm_eroded","wm_eroded"),
                                                                ("outputnode.gm_mask_file","gm_mask_file"),
                                                                ("outputnode.csf_eroded","csf_eroded"),
@@ -462,7 +482,11 @@ class AnatomicalPipeline(cmp_common.Pipeline):
                         (anat_outputnode,sinker,[("roi_volumes","anat.@roivs")]),
                         (anat_outputnode,sinker,[("roi_colorLUTs","anat.@luts")]),
                         (anat_outputnode,sinker,[("roi_graphMLs","anat.@graphmls")]),
+                        (anat_outputnode,sinker,[("roi_node_tables","anat.@nodetables")]),
                         (anat_outputnode,sinker,[("roi_volumes_stats","anat.@stats")]),
+                        (anat_outputnode,sinker,[("roi_nesting_tables","anat.@nesting")]),
+                        (anat_outputnode,sinker,[("roi_summary","anat.@summary")]),
+                        (anat_outputnode,sinker,[("thalamus_nuclei_stats","anat.@thalamus_stats")]),
                         ])
 
         self.flow = anat_flow
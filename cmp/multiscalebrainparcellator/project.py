@@ -29,6 +29,7 @@ from bids import BIDSLayout
 # Own imports
 from pipelines.anatomical import anatomical as Anatomical_pipeline
 from cmtklib.bids.utils import write_derivative_description
+from cmtklib.group import find_parcellation_stats, aggregate_parcellation_stats, save_group_stats
 from cmtklib.util import bcolors
 
 class CMP_Project_Info(HasTraits):
@@ -336,6 +337,7 @@ def create_configuration_file_participant_level(bids_dir,output_dir,subjects,sub
     anat_pipeline.stages['Parcellation'].config.segment_hippocampal_subfields = hippocampal_subfields
     anat_pipeline.stages['Parcellation'].config.segment_brainstem = brainstem_structures
     anat_pipeline.stages['Parcellation'].config.fs_number_of_cores = fs_number_of_cores
+    anat_pipeline.stages['Parcellation'].config.number_of_cores = multiproc_number_of_cores
 
     anat_save_config(pipeline=anat_pipeline,config_path=anat_pipeline.config_file)
     return project_info, anat_pipeline.config_file
@@ -386,6 +388,25 @@ def participant_level_process(project_info, configuration_file):
     return proc
 
 
+def group_level_process(output_dir, subjects, number_of_processes=1, measures=('volume-mm3',)):
+
+    derivatives_dir = os.path.join(output_dir,'cmp')
+    stats = find_parcellation_stats(derivatives_dir, subjects)
+
+    if len(stats) == 0:
+        print(bcolors.FAIL + '  * No parcellation stats found in {}. Participant level analysis has to be run first.'.format(derivatives_dir) + bcolors.ENDC)
+        return []
+
+    outputs = []
+    for scale in sorted(stats.keys()):
+        print('  * Aggregate stats of {} participants for {}'.format(len(stats[scale]),scale))
+        group_stats = aggregate_parcellation_stats(stats[scale], measures=measures, number_of_processes=number_of_processes)
+        output_prefix = os.path.join(derivatives_dir,'group','label-L2018_desc-{}'.format(scale))
+        outputs += save_group_stats(group_stats, measures, output_prefix)
+        print('    ... {} participants x {} parcels saved as {}_*'.format(len(group_stats['participant_id']),len(group_stats['index']),output_prefix))
+
+    return outputs
+
 def manage_procs(proclist):
     for proc in proclist:
         if proc.poll() is not None:
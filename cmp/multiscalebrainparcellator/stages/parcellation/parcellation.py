@@ -20,7 +20,7 @@ import nipype.pipeline.engine as pe          # pypeline engine
 import cmtklib as cmtk
 import nipype.interfaces.utility as util
 
-from cmtklib.parcellation import Parcellate, ParcellateBrainstemStructures, ParcellateHippocampalSubfields, ParcellateThalamus, CombineParcellations, ComputeParcellationRoiVolumes
+from cmtklib.parcellation import Parcellate, ParcellateBrainstemStructures, ParcellateHippocampalSubfields, RegisterThalamusTemplate, ParcellateThalamus, CombineParcellations, ComputeParcellationRoiVolumes, ComputeParcellationNesting, ComputeParcellationRoiSummary
 # Own imports
 from cmp.multiscalebrainparcellator.stages.common import Stage
 
@@ -30,10 +30,13 @@ class ParcellationConfig(HasTraits):
     include_thalamic_nuclei_parcellation = Bool(True)
     template_thalamus = File()
     thalamic_nuclei_maps = File()
+    thalamus_registration_directory = Str()
+    skip_unchanged = Bool(False)
     segment_hippocampal_subfields = Bool(True)
     segment_brainstem = Bool(True)
     pre_custom = Str('Lausanne2018')
     fs_number_of_cores = Int(1)
+    number_of_cores = Int(1)
     #atlas_name = Str()
     #number_of_regions = Int()
     #atlas_nifti_file = File(exists=True)
@@ -69,7 +72,7 @@ class ParcellationStage(Stage):
         self.config = ParcellationConfig()
         self.config.template_thalamus = pkg_resources.resource_filename('cmtklib', os.path.join('data', 'segmentation', 'thalamus2018', 'mni_icbm152_t1_tal_nlin_sym_09b_hires_1.nii.gz'))
         self.config.thalamic_nuclei_maps = pkg_resources.resource_filename('cmtklib', os.path.join('data', 'segmentation', 'thalamus2018', 'Thalamus_Nuclei-HCP-4DSPAMs.nii.gz'))
-        self.inputs = ["subjects_dir","subject_id","custom_wm_mask"]
+        self.inputs = ["subjects_dir","subject_id","custom_wm_mask","T1"]
         self.outputs = [#"aseg_file",
             "T1","brain","aseg","brain_mask",
     		"wm_mask_file",
@@ -79,7 +82,7 @@ class ParcellationStage(Stage):
             "gm_mask_file",
             "aseg","aparc_aseg",
     	       #"cc_unknown_file","ribbon_file","roi_files",
-            "roi_volumes","roi_colorLUTs","roi_graphMLs","roi_volumes_stats",
+            "roi_volumes","roi_colorLUTs","roi_graphMLs","roi_node_tables","roi_volumes_stats","roi_nesting_tables","roi_summary","thalamus_nuclei_stats",
             "parcellation_scheme","atlas_info"]
 
     def create_workflow(self, flow, inputnode, outputnode):
@@ -107,9 +110,11 @@ class ParcellationStage(Stage):
                         ])
 
             if self.config.parcellation_scheme == 'Lausanne2018':
-                parcCombiner = pe.Node(interface=CombineParcellations(),name="parcCombiner")
+                parcCombiner = pe.Node(interface=CombineParcellations(number_of_cores=self.config.number_of_cores),name="parcCombiner",n_procs=self.config.number_of_cores)
                 parcCombiner.inputs.create_colorLUT = True
                 parcCombiner.inputs.create_graphml = True
+                parcCombiner.inputs.create_node_table = True
+                parcCombiner.inputs.skip_unchanged = self.config.skip_unchanged
 
                 flow.connect([
                             (inputnode,parcCombiner,[("subjects_dir","subjects_dir"),(("subject_id",os.path.basename),"subject_id")]),
@@ -134,14 +139,24 @@ class ParcellationStage(Stage):
                                 ])
 
                 if self.config.include_thalamic_nuclei_parcellation:
-                    parcThal = pe.Node(interface=ParcellateThalamus(),name="parcThal")
+                    # The template registration only needs the input T1w image: it runs while FreeSurfer processes the subject
+                    thalReg = pe.Node(interface=RegisterThalamusTemplate(number_of_cores=self.config.fs_number_of_cores),name="thalReg",n_procs=self.config.fs_number_of_cores)
+                    thalReg.inputs.template_image = self.config.template_thalamus
+                    if self.config.skip_unchanged and self.config.thalamus_registration_directory != '':
+                        thalReg.inputs.skip_unchanged = True
+                        thalReg.inputs.store_directory = self.config.thalamus_registration_directory
+
+                    parcThal = pe.Node(interface=ParcellateThalamus(number_of_cores=self.config.fs_number_of_cores),name="parcThal",n_procs=self.config.fs_number_of_cores)
                     parcThal.inputs.template_image = self.config.template_thalamus
                     parcThal.inputs.thalamic_nuclei_maps = self.config.thalamic_nuclei_maps
 
                     flow.connect([
+                                (inputnode,thalReg,[("T1","T1w_image")]),
                                 (inputnode,parcThal,[("subjects_dir","subjects_dir"),(("subject_id",os.path.basename),"subject_id")]),
                                 (parc_node,parcThal,[("T1","T1w_image")]),
+                                (thalReg,parcThal,[("transform_file","transform_file"),("warp_file","warp_file"),("jacobian_file","jacobian_file")]),
                                 (parcThal,parcCombiner,[("max_prob_registered","thalamus_nuclei")]),
+                                (parcThal,outputnode,[("prob_maps_stats","thalamus_nuclei_stats")]),
                                 ])
 
                 flow.connect([
@@ -150,17 +165,38 @@ class ParcellationStage(Stage):
                             (parcCombiner,outputnode,[("gray_matter_mask_file","gm_mask_file")]),
                             (parcCombiner,outputnode,[("colorLUT_files","roi_colorLUTs")]),
                             (parcCombiner,outputnode,[("graphML_files","roi_graphMLs")]),
+                            (parcCombiner,outputnode,[("node_table_files","roi_node_tables")]),
                         ])
 
                 computeROIVolumetry = pe.Node(interface=ComputeParcellationRoiVolumes(), name='computeROIVolumetry')
                 computeROIVolumetry.inputs.parcellation_scheme = self.config.parcellation_scheme
+                computeROIVolumetry.inputs.compute_morphometry = True
                 
                 flow.connect([
+                            (parc_node,computeROIVolumetry,[("T1","t1w_image")]),
                             (parcCombiner,computeROIVolumetry,[("output_rois","roi_volumes")]),
                             (parcCombiner,computeROIVolumetry,[("graphML_files","roi_graphMLs")]),
                             (computeROIVolumetry,outputnode, [("roi_volumes_stats","roi_volumes_stats")]),
                             ])
 
+                computeROINesting = pe.Node(interface=ComputeParcellationNesting(), name='computeROINesting')
+                computeROINesting.inputs.parcellation_scheme = self.config.parcellation_scheme
+
+                flow.connect([
+                            (parcCombiner,computeROINesting,[("output_rois","roi_volumes")]),
+                            (computeROINesting,outputnode, [("roi_nesting_tables","roi_nesting_tables")]),
+                            ])
+
+                computeROISummary = pe.Node(interface=ComputeParcellationRoiSummary(number_of_threads=self.config.number_of_cores), name='computeROISummary')
+                computeROISummary.inputs.parcellation_scheme = self.config.parcellation_scheme
+
+                flow.connect([
+                            (parc_node,computeROISummary,[("T1","scalar_maps")]),
+                            (parcCombiner,computeROISummary,[("output_rois","roi_volumes")]),
+                            (parcCombiner,computeROISummary,[("graphML_files","roi_graphMLs")]),
+                            (computeROISummary,outputnode, [("roi_summary","roi_summary")]),
+                            ])
+
 
                     # create_atlas_info = pe.Node(interface=CreateLausanne2018AtlasInfo(),name="create_atlas_info")
                     # flow.connect([
@@ -0,0 +1,165 @@
+# Copyright (C) 2017-2019, Brain Communication Pathways Sinergia Consortium, Switzerland
+# All rights reserved.
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+""" CMTK functions for group level analysis of the parcellation outputs
+"""
+
+import os
+import os.path as op
+import re
+import multiprocessing
+from glob import glob
+
+import numpy as np
+
+STATS_PATTERN = re.compile(r'^(?P<participant>.+)_label-L2018_desc-(?P<scale>scale\d+)_stats\.tsv$')
+
+def find_parcellation_stats(derivatives_dir, subjects=None):
+    """ Returns the stats TSV files of the Lausanne2018 parcellations found in ``derivatives_dir``.
+
+    Parameters
+    ----------
+    derivatives_dir : str
+        Directory of the participant level outputs (``<output_dir>/cmp``)
+
+    subjects : list
+        Subjects (``sub-<label>``) to consider (all subjects if None)
+
+    Returns
+    -------
+    stats : dict
+        Scale (e.g. ``scale1``): sorted list of (participant, stats TSV file) pairs,
+        the participant being ``sub-<label>`` or ``sub-<label>_ses-<label>``
+    """
+    if subjects is None:
+        subjects = ['sub-*']
+    files = []
+    for subject in subjects:
+        files += glob(op.join(derivatives_dir, subject, 'anat', '*_label-L2018_desc-scale*_stats.tsv'))
+        files += glob(op.join(derivatives_dir, subject, 'ses-*', 'anat', '*_label-L2018_desc-scale*_stats.tsv'))
+    stats = {}
+    for filename in sorted(set(files)):
+        match = STATS_PATTERN.match(op.basename(filename))
+        if match is not None:
+            stats.setdefault(match.group('scale'), []).append((match.group('participant'), filename))
+    return stats
+
+def read_parcellation_stats(filename, measures=('volume-mm3',)):
+    """ Reads the ``measures`` columns of a parcellation stats TSV file.
+
+    Values ``n/a`` and columns missing from the file are read as NaN.
+
+    Returns
+    -------
+    index : numpy.ndarray
+        Parcel labels
+    names : list
+        Parcel names
+    values : numpy.ndarray
+        Array of shape (number of parcels, number of measures) stored as float32
+    """
+    with open(filename, 'r') as f:
+        header = [column.strip() for column in f.readline().split(',')]
+        rows = [[value.strip() for value in line.split(',')] for line in f if line.strip() != '']
+    columns = [header.index(measure) if measure in header else None for measure in measures]
+    index = np.array([int(row[header.index('index')]) for row in rows], dtype=np.int64)
+    names = [row[header.index('name')] for row in rows]
+    values = np.full((len(rows), len(measures)), np.nan, dtype=np.float32)
+    for j, column in enumerate(columns):
+        if column is not None:
+            values[:, j] = [float(row[column]) if row[column] != 'n/a' else np.nan for row in rows]
+    return index, names, values
+
+def _read_parcellation_stats(args):
+    return read_parcellation_stats(*args)
+
+def aggregate_parcellation_stats(stats_files, measures=('volume-mm3',), number_of_processes=1):
+    """ Aggregates the stats TSV files of several participants for one parcellation scale.
+
+    Files are read by a pool of ``number_of_processes`` processes and streamed into
+    the participant x parcel matrices, so that only the matrices are kept in memory.
+    Parcels are sorted by label; parcels absent from a file are set to NaN.
+
+    Parameters
+    ----------
+    stats_files : list
+        List of (participant, stats TSV file) pairs
+
+    measures : list
+        Columns of the stats TSV files to aggregate
+
+    number_of_processes : int
+        Number of processes reading the files
+
+    Returns
+    -------
+    group_stats : dict
+        ``participant_id`` (participants), ``index`` (parcel labels), ``name`` (parcel
+        names) and, for each measure, its float32 matrix of shape (number of participants,
+        number of parcels)
+    """
+    measures = list(measures)
+    participants = [participant for participant, _ in stats_files]
+    jobs = [(filename, measures) for _, filename in stats_files]
+
+    # Matrix columns are allocated for the parcels of the first file and extended
+    # whenever a file describes new parcels
+    columns = {}
+    index = []
+    names = []
+    data = np.full((len(jobs), 0, len(measures)), np.nan, dtype=np.float32)
+
+    if number_of_processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=number_of_processes)
+        results = pool.imap(_read_parcellation_stats, jobs, chunksize=max(1, min(64, len(jobs) // (4 * number_of_processes))))
+    else:
+        pool = None
+        results = (_read_parcellation_stats(job) for job in jobs)
+
+    try:
+        for row, (file_index, file_names, values) in enumerate(results):
+            new_parcels = [(label, name) for label, name in zip(file_index.tolist(), file_names) if label not in columns]
+            if len(new_parcels) > 0:
+                for label, name in new_parcels:
+                    columns[label] = len(index)
+                    index.append(label)
+                    names.append(name)
+                data = np.concatenate([data, np.full((len(jobs), len(new_parcels), len(measures)), np.nan, dtype=np.float32)], axis=1)
+            data[row, [columns[label] for label in file_index.tolist()], :] = values
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    order = np.argsort(index, kind='mergesort')
+    group_stats = {'participant_id': np.array(participants),
+                   'index': np.array(index, dtype=np.int64)[order],
+                   'name': np.array(names)[order]}
+    for j, measure in enumerate(measures):
+        group_stats[measure] = np.ascontiguousarray(data[:, order, j])
+    return group_stats
+
+def save_group_stats(group_stats, measures, output_prefix):
+    """ Saves aggregated stats as ``<output_prefix>_stats.npz`` and one TSV file per measure
+    (``<output_prefix>_<measure>.tsv``, one row per participant and one column per parcel).
+
+    Returns the list of files written.
+    """
+    output_dir = op.dirname(output_prefix)
+    if output_dir != '' and not op.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    npz_file = '{}_stats.npz'.format(output_prefix)
+    np.savez(npz_file, **group_stats)
+    filenames = [npz_file]
+
+    for measure in measures:
+        tsv_file = '{}_{}.tsv'.format(output_prefix, measure)
+        with open(tsv_file, 'w') as f:
+            f.write('\t'.join(['participant_id'] + group_stats['name'].tolist()) + '\n')
+            for participant, values in zip(group_stats['participant_id'].tolist(), group_stats[measure]):
+                f.write('\t'.join([participant] + ['n/a' if np.isnan(v) else np.format_float_positional(v, trim='-') for v in values]) + '\n')
+        filenames.append(tsv_file)
+    return filenames
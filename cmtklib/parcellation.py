@@ -12,19 +12,21 @@ import os.path as op
 import pkg_resources
 import subprocess
 import shutil
+import tempfile
 import nibabel as ni
-import networkx as nx
 import numpy as np
 import math
+import inspect
 
 from scipy import ndimage
+from scipy import sparse
 
 import scipy.ndimage.morphology as nd
 import sys
 from time import time, localtime, strftime
-from nipype.interfaces.base import traits, BaseInterfaceInputSpec, TraitedSpec, BaseInterface, Directory, File, InputMultiPath, OutputMultiPath
+from nipype.interfaces.base import traits, isdefined, BaseInterfaceInputSpec, TraitedSpec, BaseInterface, Directory, File, InputMultiPath, OutputMultiPath
 
-from util import bcolors
+from util import bcolors, string_types, AsyncImageWriter, BoundingBox, OutputStore, VolumeCache, empty_mask, as_labels, label_dtype, read_graphml_nodes, remove_small_components
 
 from nipype.utils.logger import logging
 iflogger = logging.getLogger('nipype.interface')
@@ -34,6 +36,13 @@ try:
 except ImportError:
     raise Exception('Need scipy for binary erosion of white matter and CSF masks')
 
+def find_scale_file(scale, filenames):
+    """ Returns the first file of ``filenames`` whose path contains the name of the ``scale`` """
+    for filename in filenames:
+        if scale in filename:
+            return filename
+    raise ValueError("No file found for {} in {}".format(scale, filenames))
+
 class ComputeParcellationRoiVolumesInputSpec(BaseInterfaceInputSpec):
     """ 
     This is a class for the definition of inputs of the ComputeParcellationRoiVolumes nipype interface. 
@@ -42,10 +51,14 @@ class ComputeParcellationRoiVolumesInputSpec(BaseInterfaceInputSpec):
         roi_volumes (files): ROI volumes registered to diffusion space
         parcellation_scheme (files): Parcellation scheme being used (only Lausanne2018) 
         roi_graphMLs (files): GraphML description of ROI volumes (Lausanne2018)
+        compute_morphometry (bool): Add the morphometry of each ROI to the TSV files
+        t1w_image (file): T1w image in the space of the ROI volumes, used for the intensity statistics
     """
     roi_volumes = InputMultiPath(File(exists=True), desc='ROI volumes registered to diffusion space', mandatory=True)
     parcellation_scheme = traits.Enum('Lausanne2018',['Lausanne2018'], usedefault=True, mandatory=True)
     roi_graphMLs = InputMultiPath(File(exists=True), desc='GraphML description of ROI volumes (Lausanne2018)', mandatory=True)
+    compute_morphometry = traits.Bool(False, usedefault=True, desc='Add voxel count, centroid, bounding box, surface-voxel count and T1w intensity statistics of each ROI to the TSV files')
+    t1w_image = File(exists=True, desc='T1w image in the space of the ROI volumes, used to compute the mean and SD of intensity in each ROI')
     
 class ComputeParcellationRoiVolumesOutputSpec(TraitedSpec):
     """ 
@@ -67,18 +80,17 @@ class ComputeParcellationRoiVolumes(BaseInterface):
     def _run_interface(self, runtime):
 
         resolutions = get_parcellation(self.inputs.parcellation_scheme) 
-        
-        for parkey, parval in resolutions.items():
 
-            for roi in self.inputs.roi_volumes:
-                if parkey in roi:
-                    roi_fname = roi
-                    break
+        # The T1w image is loaded once for all the scales
+        t1wData = None
+        if self.inputs.compute_morphometry and isdefined(self.inputs.t1w_image):
+            iflogger.info("  > Load {}...".format(self.inputs.t1w_image))
+            t1wData = ni.load(self.inputs.t1w_image).get_data()
 
-            for graphml in self.inputs.roi_graphMLs:
-                if parkey in graphml:
-                    roi_info_graphml = graphml
-                    break
+        for parkey, parval in resolutions.items():
+
+            roi_fname = find_scale_file(parkey, self.inputs.roi_volumes)
+            roi_info_graphml = find_scale_file(parkey, self.inputs.roi_graphMLs)
 
             iflogger.info("-------------------------------------------------------")
             iflogger.info("Processing {} parcellation - {}".format(self.inputs.parcellation_scheme,parkey))
@@ -101,15 +113,34 @@ class ComputeParcellationRoiVolumes(BaseInterface):
             # Format the TSV file according to BIDS Extension Proposal 11 (BEP011): The structural preprocessing derivatives.
             time_now = strftime("%a %d %b %Y %H:%M:%S",localtime())
             hdr_lines = ['{:<4}, {:<55}, {:<10}, {:>10} \n'.format("index","name","type","volume-mm3")]
+            if self.inputs.compute_morphometry:
+                hdr_lines = ['{:<4}, {:<55}, {:<10}, {:>10}, {} \n'.format("index","name","type","volume-mm3",", ".join(ROI_MORPHOMETRY_COLUMNS))]
             
             f_volumetry.writelines(hdr_lines)
             del hdr_lines
 
             # add node information from parcellation
             iflogger.info("  > Load {}...".format(roi_info_graphml))
-            gp = nx.read_graphml(roi_info_graphml)
+            gp = read_graphml_nodes(roi_info_graphml)
             n_nodes = len(gp)
 
+            # Count the voxels of all the labels in a single pass
+            label_counts = np.bincount(label_keys(roiData).ravel())
+
+            if self.inputs.compute_morphometry:
+                iflogger.info("  > Compute morphometry of all parcels...")
+                morphometry = compute_roi_morphometry(roiData, roiImg.affine, t1wData)
+
+            # Report labels present only in the image or only in the graphml
+            image_labels = set(np.flatnonzero(label_counts[1:]) + 1)
+            graphml_labels = set(gp["dn_multiscaleID"].astype(int).tolist())
+            missing_in_graphml = sorted(image_labels - graphml_labels)
+            missing_in_image = sorted(graphml_labels - image_labels)
+            if len(missing_in_graphml) > 0:
+                iflogger.warning("  > Labels of {} not described in {}: {}".format(roi_fname, roi_info_graphml, missing_in_graphml))
+            if len(missing_in_image) > 0:
+                iflogger.warning("  > Labels of {} not found in {}: {}".format(roi_info_graphml, roi_fname, missing_in_image))
+
             # variables used by the percent counter
             pc=-1
             cnt=-1
@@ -135,9 +166,15 @@ class ComputeParcellationRoiVolumes(BaseInterface):
                 parcel_name = d["dn_name"]
 
                 # Compute the parcel/ROI volume
-                parcel_volumetry = np.sum( roiData== int(d["dn_multiscaleID"]) ) * voxel_volume
+                label = int(d["dn_multiscaleID"])
+                parcel_count = label_counts[label] if 0 < label < label_counts.size else np.int64(0)
+                parcel_volumetry = parcel_count * voxel_volume
 
-                f_volumetry.write('{:<4}, {:<55}, {:<10}, {:>10} \n'.format(parcel_label,parcel_name,parcel_type,parcel_volumetry))
+                if self.inputs.compute_morphometry:
+                    f_volumetry.write('{:<4}, {:<55}, {:<10}, {:>10}, {} \n'.format(parcel_label,parcel_name,parcel_type,parcel_volumetry,
+                                                                                   ", ".join(format_roi_morphometry(morphometry, label))))
+                else:
+                    f_volumetry.write('{:<4}, {:<55}, {:<10}, {:>10} \n'.format(parcel_label,parcel_name,parcel_type,parcel_volumetry))
 
             f_volumetry.close()
 
@@ -157,6 +194,436 @@ class ComputeParcellationRoiVolumes(BaseInterface):
             filepaths.append(op.abspath(basename+'_'+scale+posfix))
         return filepaths
 
+ROI_MORPHOMETRY_COLUMNS = ["voxels",
+                           "centroid-x-mm", "centroid-y-mm", "centroid-z-mm",
+                           "bbox-i-min", "bbox-j-min", "bbox-k-min", "bbox-i-max", "bbox-j-max", "bbox-k-max",
+                           "surface-voxels", "t1w-mean", "t1w-sd"]
+
+def compute_roi_morphometry(roiData, affine, intensity=None):
+    """ Computes the morphometry of all the labels of a parcellation in one sweep.
+
+    Parameters
+    ----------
+    roiData : numpy.ndarray
+        3D label volume
+
+    affine : numpy.ndarray
+        Voxel to world (mm) transform of the label volume
+
+    intensity : numpy.ndarray
+        Optional image (e.g. T1w) in the same space, whose mean and standard deviation are computed in each label
+
+    Returns
+    -------
+    morphometry : dict
+        Arrays indexed by label: ``voxels`` (voxel count), ``centroid`` (world coordinates in mm),
+        ``bbox_min`` and ``bbox_max`` (first and last voxel indices, -1 if the label is absent),
+        ``surface_voxels`` (voxels with a 6-neighbour of another label) and, if ``intensity``
+        is given, ``mean`` and ``sd``.
+    """
+    keys = label_keys(roiData)
+    n = int(keys.max()) + 1
+    voxels = np.bincount(keys.ravel(), minlength=n)
+    present = voxels > 0
+    present[0] = False
+
+    # Centroids from the coordinate sums of the labelled voxels
+    ind = np.flatnonzero(keys)
+    labels = keys.ravel()[ind]
+    coords = np.unravel_index(ind, keys.shape)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroid_vox = np.column_stack([np.bincount(labels, weights=c, minlength=n) / voxels for c in coords])
+    centroid = ni.affines.apply_affine(affine, centroid_vox)
+    centroid[~present] = np.nan
+
+    # Bounding boxes from the slices of each label
+    bbox_min = -np.ones((n, 3), dtype=int)
+    bbox_max = -np.ones((n, 3), dtype=int)
+    for label, box in enumerate(ndimage.find_objects(keys), 1):
+        if box is not None:
+            bbox_min[label] = [sl.start for sl in box]
+            bbox_max[label] = [sl.stop - 1 for sl in box]
+
+    # Surface voxels have at least one 6-neighbour with another label (or outside the volume)
+    surface = np.zeros(keys.shape, dtype=bool)
+    for axis in range(3):
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+        different = keys[tuple(lower)] != keys[tuple(upper)]
+        surface[tuple(lower)] |= different
+        surface[tuple(upper)] |= different
+        border = [slice(None)] * 3
+        border[axis] = 0
+        surface[tuple(border)] = True
+        border[axis] = -1
+        surface[tuple(border)] = True
+    surface_voxels = np.bincount(keys[surface], minlength=n)
+
+    morphometry = {'voxels': voxels, 'centroid': centroid, 'bbox_min': bbox_min, 'bbox_max': bbox_max,
+                   'surface_voxels': surface_voxels}
+
+    # Intensity mean and standard deviation from the weighted sums of the values and squared values
+    if intensity is not None:
+        if intensity.shape[:3] != keys.shape:
+            raise ValueError('Intensity image of shape {} does not match the label volume of shape {}'.format(intensity.shape, keys.shape))
+        values = np.asarray(intensity, dtype=np.float64).ravel()[ind]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(labels, weights=values, minlength=n) / voxels
+            sd = np.sqrt(np.maximum(np.bincount(labels, weights=values * values, minlength=n) / voxels - mean * mean, 0))
+        mean[~present] = np.nan
+        sd[~present] = np.nan
+        morphometry['mean'] = mean
+        morphometry['sd'] = sd
+
+    return morphometry
+
+def format_roi_morphometry(morphometry, label):
+    """ Returns the values of the ``ROI_MORPHOMETRY_COLUMNS`` of ``label`` as strings ("n/a" if not available) """
+    if label < 0 or label >= morphometry['voxels'].size or morphometry['voxels'][label] == 0 or label == 0:
+        return ["0"] + ["n/a"] * (len(ROI_MORPHOMETRY_COLUMNS) - 1)
+    values = ["{}".format(morphometry['voxels'][label])]
+    values += ["{:.2f}".format(v) for v in morphometry['centroid'][label]]
+    values += ["{}".format(v) for v in morphometry['bbox_min'][label]]
+    values += ["{}".format(v) for v in morphometry['bbox_max'][label]]
+    values += ["{}".format(morphometry['surface_voxels'][label])]
+    if 'mean' in morphometry:
+        values += ["{:.4f}".format(morphometry['mean'][label]), "{:.4f}".format(morphometry['sd'][label])]
+    else:
+        values += ["n/a", "n/a"]
+    return values
+
+def compute_label_nesting(childData, parentData):
+    """ Computes the contingency of the labels of two parcellations of the same volume in one pass.
+
+    Each label of the finer parcellation ``childData`` is assigned to the label of
+    ``parentData`` it overlaps the most. Voxels of a child label outside its parent,
+    including those in the background of ``parentData``, violate the nesting.
+
+    Parameters
+    ----------
+    childData : numpy.ndarray
+        3D label volume of the finer parcellation
+
+    parentData : numpy.ndarray
+        3D label volume of the coarser parcellation
+
+    Returns
+    -------
+    nesting : dict
+        ``contingency`` (number of voxels of each child label, rows, in each parent label,
+        columns), and arrays indexed by child label: ``voxels`` (voxel count), ``parent``
+        (parent label, 0 if the label is absent or entirely in the background of the parent
+        parcellation) and ``overlap`` (voxels in the parent label). ``violation_fraction`` is
+        the fraction of the labelled voxels of ``childData`` outside their parent label.
+    """
+    child = label_keys(childData)
+    parent = label_keys(parentData)
+    if child.shape != parent.shape:
+        raise ValueError("Parcellations of shapes {} and {} cannot be compared".format(child.shape, parent.shape))
+
+    n_child = int(child.max()) + 1
+    n_parent = int(parent.max()) + 1
+    ind = np.flatnonzero(child)
+    keys = child.ravel()[ind].astype(np.int64) * n_parent + parent.ravel()[ind]
+    contingency = np.bincount(keys, minlength=n_child * n_parent).reshape(n_child, n_parent)
+
+    voxels = contingency.sum(axis=1)
+    parent_labels = np.zeros(n_child, dtype=np.int64)
+    if n_parent > 1:
+        parent_labels = np.argmax(contingency[:, 1:], axis=1) + 1
+    overlap = contingency[np.arange(n_child), parent_labels]
+    parent_labels[overlap == 0] = 0
+    overlap[parent_labels == 0] = 0
+
+    total = voxels.sum()
+    violation_fraction = float(total - overlap.sum()) / total if total > 0 else 0.0
+    return {'contingency': contingency, 'voxels': voxels, 'parent': parent_labels,
+            'overlap': overlap, 'violation_fraction': violation_fraction}
+
+def compute_label_adjacency(labelData):
+    """ Computes the voxel-face adjacency of the labels of a parcellation.
+
+    Neighbouring voxels are compared by shifting the volume by one voxel along each
+    axis, and the pairs of different non-zero labels are counted with a single bincount.
+
+    Parameters
+    ----------
+    labelData : numpy.ndarray
+        3D label volume
+
+    Returns
+    -------
+    edges : numpy.ndarray
+        Array of shape (number of edges, 3) of (label, neighbour label, number of shared
+        voxel faces), with label < neighbour label, sorted by label pair
+    """
+    keys = label_keys(labelData)
+    n = int(keys.max()) + 1 if keys.size else 1
+    pairs = []
+    for axis in range(keys.ndim):
+        a = keys[(slice(None),) * axis + (slice(None, -1),)]
+        b = keys[(slice(None),) * axis + (slice(1, None),)]
+        boundary = (a != b) & (a > 0) & (b > 0)
+        a = a[boundary].astype(np.int64)
+        b = b[boundary].astype(np.int64)
+        pairs.append(np.minimum(a, b) * n + np.maximum(a, b))
+    counts = np.bincount(np.concatenate(pairs), minlength=n * n) if n > 1 else np.zeros(1, dtype=np.int64)
+    pair_keys = np.flatnonzero(counts)
+    return np.c_[pair_keys // n, pair_keys % n, counts[pair_keys]].astype(np.int64)
+
+class ComputeParcellationNestingInputSpec(BaseInterfaceInputSpec):
+    """
+    This is a class for the definition of inputs of the ComputeParcellationNesting nipype interface.
+
+    Attributes:
+        roi_volumes (files): ROI volumes of all the scales
+        parcellation_scheme (files): Parcellation scheme being used (only Lausanne2018)
+        parent_scale (str): Scale whose parcels are the parents of the parcels of the other scales,
+            or 'previous' to nest each scale in the previous (coarser) one
+    """
+    roi_volumes = InputMultiPath(File(exists=True), desc='ROI volumes of all the scales', mandatory=True)
+    parcellation_scheme = traits.Enum('Lausanne2018',['Lausanne2018'], usedefault=True, mandatory=True)
+    parent_scale = traits.Str('previous', usedefault=True, desc='Scale whose parcels are the parents of the parcels of the other scales, or "previous" to nest each scale in the previous (coarser) one')
+
+class ComputeParcellationNestingOutputSpec(TraitedSpec):
+    """
+    This is a class for the definition of outputs of the ComputeParcellationNesting nipype interface.
+
+    Attributes:
+        roi_nesting_tables (files): TSV files with the parent of each ROI for each scale, and the summary of the nesting violations
+    """
+    roi_nesting_tables = OutputMultiPath(File())
+
+class ComputeParcellationNesting(BaseInterface):
+    """
+    This is a class for the definition of the ComputeParcellationNesting nipype interface.
+    It maps each ROI of each parcellation scale to its parent ROI of the previous scale
+    (or of a given parent scale) and computes the fraction of voxels violating the nesting of the scales.
+    """
+    input_spec = ComputeParcellationNestingInputSpec
+    output_spec = ComputeParcellationNestingOutputSpec
+
+    def _scale_pairs(self):
+        """ Returns the (scale, parent scale) pairs """
+        scales = sorted(get_parcellation(self.inputs.parcellation_scheme).keys())
+        if self.inputs.parent_scale == 'previous':
+            return list(zip(scales[1:], scales[:-1]))
+        return [(scale, self.inputs.parent_scale) for scale in scales if scale != self.inputs.parent_scale]
+
+    def _run_interface(self, runtime):
+
+        # Each scale is loaded once, when it is first needed as a parcellation or as a parent
+        volumes = {}
+        def load_scale(scale):
+            if scale not in volumes:
+                roi_fname = find_scale_file(scale, self.inputs.roi_volumes)
+                iflogger.info("  > Load {}...".format(roi_fname))
+                volumes[scale] = ni.load(roi_fname).get_data()
+            return volumes[scale]
+
+        summary_lines = ['\t'.join(["scale", "parent-scale", "voxels", "violating-voxels", "violation-fraction"]) + '\n']
+
+        for scale, parent_scale in self._scale_pairs():
+            nesting = compute_label_nesting(load_scale(scale), load_scale(parent_scale))
+
+            labels = np.flatnonzero(nesting['voxels'])
+            lines = ['\t'.join(["index", "parent-index", "voxels", "parent-voxels", "violation-fraction"]) + '\n']
+            for label in labels.tolist():
+                voxels = nesting['voxels'][label]
+                overlap = nesting['overlap'][label]
+                lines.append('\t'.join([str(label), str(nesting['parent'][label]), str(voxels), str(overlap),
+                                        '{:.6f}'.format(float(voxels - overlap) / voxels)]) + '\n')
+
+            nesting_file = op.abspath('roi_nesting_{}.tsv'.format(scale))
+            iflogger.info("  > Save nesting of {} in {} as {}".format(scale, parent_scale, nesting_file))
+            with open(nesting_file, 'w') as f:
+                f.write(''.join(lines))
+
+            total = nesting['voxels'].sum()
+            summary_lines.append('\t'.join([scale, parent_scale, str(total), str(total - nesting['overlap'].sum()),
+                                            '{:.6f}'.format(nesting['violation_fraction'])]) + '\n')
+            iflogger.info("    ... {:.2f}% of the voxels violate the nesting".format(100 * nesting['violation_fraction']))
+
+            # With consecutive scales, the parent is not needed anymore
+            if self.inputs.parent_scale == 'previous':
+                del volumes[parent_scale]
+
+        with open(op.abspath('roi_nesting.tsv'), 'w') as f:
+            f.write(''.join(summary_lines))
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['roi_nesting_tables'] = [op.abspath('roi_nesting.tsv')] + [op.abspath('roi_nesting_{}.tsv'.format(scale)) for scale, _ in self._scale_pairs()]
+        return outputs
+
+def compute_regional_summary(labelVolumes, scalarData, percentiles=(25, 50, 75)):
+    """ Computes summary statistics of a scalar map within each label of one or more parcellations.
+
+    The finite values of the map are sorted once. For each parcellation, the voxels are then
+    grouped by label with a counting sort (linear in the number of voxels) that keeps the
+    values of each label in increasing order, from which all the statistics are read
+    without another sort or one masked pass per label.
+
+    Parameters
+    ----------
+    labelVolumes : list
+        3D label volumes (e.g. the scales of a parcellation) in the space of ``scalarData``
+
+    scalarData : numpy.ndarray
+        3D scalar map
+
+    percentiles : list
+        Percentiles (between 0 and 100) computed with linear interpolation
+
+    Returns
+    -------
+    summaries : list
+        For each label volume, a dict of arrays indexed by position in ``labels``
+        (the labels present in the volume): ``voxels``, ``mean``, ``sd``, ``min``,
+        ``max`` and ``percentiles`` (array of shape (number of labels, number of percentiles))
+    """
+    values = np.asarray(scalarData, dtype=np.float64).ravel()
+    finite = np.flatnonzero(np.isfinite(values))
+    value_order = finite[np.argsort(values[finite], kind='quicksort')]
+    sorted_values = values[value_order]
+    fractions = np.asarray(percentiles, dtype=np.float64) / 100.
+
+    summaries = []
+    for labelData in labelVolumes:
+        keys = label_keys(labelData)
+        if keys.shape != np.shape(scalarData):
+            raise ValueError("Scalar map of shape {} does not match the parcellation of shape {}".format(np.shape(scalarData), keys.shape))
+        labels = keys.ravel()[value_order]
+        labelled = np.flatnonzero(labels)
+
+        if labelled.size == 0:
+            summaries.append({'labels': np.zeros(0, dtype=np.int64), 'voxels': np.zeros(0, dtype=np.int64),
+                              'mean': np.zeros(0), 'sd': np.zeros(0), 'min': np.zeros(0), 'max': np.zeros(0),
+                              'percentiles': np.zeros((0, fractions.size))})
+            continue
+
+        # The (label, rank of the value) pairs converted to CSR are grouped by label (row) by a counting
+        # sort, which keeps the ranks of each label in increasing order, i.e. its values in increasing order
+        groups = sparse.csr_matrix((np.ones(labelled.size, dtype=np.int8), (labels[labelled], labelled)),
+                                   shape=(int(labels.max()) + 1, value_order.size))
+        group_values = sorted_values[groups.indices]
+        counts = np.diff(groups.indptr)
+        present = np.flatnonzero(counts)
+        starts = groups.indptr[present]
+        ends = groups.indptr[present + 1]
+        voxels = ends - starts
+        sums = np.add.reduceat(group_values, starts)
+        mean = sums / voxels
+        sd = np.sqrt(np.maximum(np.add.reduceat(group_values ** 2, starts) / voxels - mean ** 2, 0))
+
+        # Linear interpolation between the closest ranks, as numpy.percentile
+        positions = starts[:, None] + fractions[None, :] * (voxels - 1)[:, None]
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.minimum(lower + 1, (ends - 1)[:, None])
+        weights = positions - lower
+        percentile_values = group_values[lower] * (1 - weights) + group_values[upper] * weights
+
+        summaries.append({'labels': present.astype(np.int64), 'voxels': voxels,
+                          'mean': mean, 'sd': sd, 'min': group_values[starts], 'max': group_values[ends - 1],
+                          'percentiles': percentile_values})
+    return summaries
+
+class ComputeParcellationRoiSummaryInputSpec(BaseInterfaceInputSpec):
+    """
+    This is a class for the definition of inputs of the ComputeParcellationRoiSummary nipype interface.
+
+    Attributes:
+        roi_volumes (files): ROI volumes of all the scales
+        parcellation_scheme (files): Parcellation scheme being used (only Lausanne2018)
+        roi_graphMLs (files): GraphML description of ROI volumes (Lausanne2018)
+        scalar_maps (files): Scalar maps (e.g. T1w, partial volume or Jacobian maps) in the space of the ROI volumes
+        percentiles (list): Percentiles computed in each ROI
+        number_of_threads (int): Number of scalar maps processed in parallel
+    """
+    roi_volumes = InputMultiPath(File(exists=True), desc='ROI volumes of all the scales', mandatory=True)
+    parcellation_scheme = traits.Enum('Lausanne2018',['Lausanne2018'], usedefault=True, mandatory=True)
+    roi_graphMLs = InputMultiPath(File(exists=True), desc='GraphML description of ROI volumes (Lausanne2018)', mandatory=True)
+    scalar_maps = InputMultiPath(File(exists=True), desc='Scalar maps (e.g. T1w, partial volume or Jacobian maps) in the space of the ROI volumes', mandatory=True)
+    percentiles = traits.List(traits.Float(), [5, 25, 50, 75, 95], usedefault=True, desc='Percentiles computed in each ROI')
+    number_of_threads = traits.Int(1, usedefault=True, desc='Number of scalar maps processed in parallel')
+
+class ComputeParcellationRoiSummaryOutputSpec(TraitedSpec):
+    """
+    This is a class for the definition of outputs of the ComputeParcellationRoiSummary nipype interface.
+
+    Attributes:
+        roi_summary (file): TSV file with one row per scalar map, scale and ROI
+    """
+    roi_summary = File()
+
+class ComputeParcellationRoiSummary(BaseInterface):
+    """
+    This is a class for the definition of the ComputeParcellationRoiSummary nipype interface.
+    It computes the mean, standard deviation, range and percentiles of scalar maps
+    within each ROI of each parcellation scale and saves them as a tidy TSV table.
+    """
+    input_spec = ComputeParcellationRoiSummaryInputSpec
+    output_spec = ComputeParcellationRoiSummaryOutputSpec
+
+    def _run_interface(self, runtime):
+        from multiprocessing.pool import ThreadPool
+
+        scales = sorted(get_parcellation(self.inputs.parcellation_scheme).keys())
+
+        # Label volumes and ROI names are loaded once and shared by all the scalar maps
+        labelVolumes = []
+        names = []
+        for scale in scales:
+            roi_fname = find_scale_file(scale, self.inputs.roi_volumes)
+            iflogger.info("  > Load {}...".format(roi_fname))
+            labelVolumes.append(label_keys(ni.load(roi_fname).get_data()))
+            gp = read_graphml_nodes(find_scale_file(scale, self.inputs.roi_graphMLs))
+            names.append(dict(zip(gp["dn_multiscaleID"].astype(int).tolist(), gp["dn_name"].tolist())))
+
+        percentiles = list(self.inputs.percentiles)
+
+        def summarize(scalar_map):
+            iflogger.info("  > Summarize {} in all the ROIs...".format(scalar_map))
+            return compute_regional_summary(labelVolumes, ni.load(scalar_map).get_data(), percentiles)
+
+        scalar_maps = list(self.inputs.scalar_maps)
+        number_of_threads = max(1, min(self.inputs.number_of_threads, len(scalar_maps)))
+        if number_of_threads > 1:
+            pool = ThreadPool(number_of_threads)
+            try:
+                results = pool.map(summarize, scalar_maps)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [summarize(scalar_map) for scalar_map in scalar_maps]
+
+        columns = ["map", "scale", "index", "name", "voxels", "mean", "sd", "min"] + ["p{:g}".format(p) for p in percentiles] + ["max"]
+        lines = ['\t'.join(columns) + '\n']
+        for scalar_map, summaries in zip(scalar_maps, results):
+            map_name = op.basename(scalar_map).split('.')[0]
+            for scale, scale_names, summary in zip(scales, names, summaries):
+                for i, label in enumerate(summary['labels'].tolist()):
+                    row = [map_name, scale, str(label), scale_names.get(label, 'n/a'), str(summary['voxels'][i])]
+                    row += ['{:.6g}'.format(v) for v in [summary['mean'][i], summary['sd'][i], summary['min'][i]]]
+                    row += ['{:.6g}'.format(v) for v in summary['percentiles'][i]]
+                    row += ['{:.6g}'.format(summary['max'][i])]
+                    lines.append('\t'.join(row) + '\n')
+
+        with open(op.abspath('roi_summary.tsv'), 'w') as f:
+            f.write(''.join(lines))
+
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['roi_summary'] = op.abspath('roi_summary.tsv')
+        return outputs
+
 def erode_mask(maskFile):
     """ Erodes the mask """
     # Define erosion mask
@@ -165,8 +632,8 @@ def erode_mask(maskFile):
     se[1,:,1] = 1; se[:,1,1] = 1; se[1,1,:] = 1
 
     # Erode mask
-    mask = ni.load( maskFile ).get_data().astype( np.uint32 )
-    er_mask = np.zeros( mask.shape )
+    mask = as_labels(ni.load( maskFile ).get_data())
+    er_mask = empty_mask( mask.shape )
     idx = np.where( (mask == 1) )
     er_mask[idx] = 1
     er_mask = imerode(er_mask,se)
@@ -174,6 +641,34 @@ def erode_mask(maskFile):
     img = ni.Nifti1Image(er_mask, ni.load( maskFile ).get_affine(), ni.load( maskFile ).get_header())
     ni.save(img, op.abspath('%s_eroded.nii.gz' % os.path.splitext(op.splitext(op.basename(maskFile))[0])[0]))
 
+def spherical_structure(radius, voxel_sizes):
+    """ Returns a boolean spherical structuring element of ``radius`` (in mm)
+    for a grid of the given voxel sizes (in mm), as the fslmaths ``-kernel sphere`` kernel """
+    half = [int(np.floor(radius / float(v))) for v in voxel_sizes]
+    grid = np.ogrid[tuple(slice(-h, h + 1) for h in half)]
+    dist2 = sum((g * float(v)) ** 2 for g, v in zip(grid, voxel_sizes))
+    return dist2 <= radius ** 2
+
+def dilate_mask_sphere(mask, radius, voxel_sizes):
+    """ Dilates a binary mask with a sphere of ``radius`` (in mm).
+
+    The dilation is computed in the bounding box of the mask padded by the radius,
+    which gives the same result as dilating the whole volume.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    dilated = np.zeros(mask.shape, dtype=bool)
+    if not mask.any():
+        return dilated
+
+    se = spherical_structure(radius, voxel_sizes)
+    half = (np.array(se.shape) - 1) // 2
+    ind = np.nonzero(mask)
+    lower = np.maximum([i.min() for i in ind] - half, 0)
+    upper = np.minimum([i.max() for i in ind] + half + 1, mask.shape)
+    bbox = tuple(slice(l, u) for l, u in zip(lower, upper))
+    dilated[bbox] = nd.binary_dilation(mask[bbox], structure=se)
+    return dilated
+
 class Erode_inputspec(BaseInterfaceInputSpec):
     in_file = File(exists=True)
 
@@ -304,6 +799,267 @@ class ParcellateBrainstemStructures(BaseInterface):
         outputs['brainstem_structures'] = op.abspath('brainstem.nii.gz')
         return outputs
 
+def label_keys(data):
+    """ Returns ``data`` as a non-negative integer array usable as a lookup-table index.
+
+    Non-integer and negative values are mapped to 0 (background).
+    """
+    data = np.asarray(data)
+    if data.dtype.kind == 'f':
+        keys = data.astype(np.int32)
+        # Non-integer values do not match any label
+        keys[keys != data] = 0
+    else:
+        keys = data.astype(np.int32, copy=False)
+    if keys.size and keys.min() < 0:
+        keys = np.where(keys < 0, 0, keys)
+    return keys
+
+class LabelRemapper(object):
+    """ Accumulates ordered label assignments and applies them with one lookup-table
+    pass per source volume.
+
+    Each call to ``add`` is equivalent to the sequence
+    ``for o, n in zip(old, new): out[source == o] = n`` and each call to ``add_indices``
+    to ``out[indices] = label``. Later steps overwrite earlier ones, exactly as the
+    sequential ``np.where`` assignments they replace. The running maximum label
+    (``It.max()`` in the sequential version) is tracked from the label histogram of
+    each source, so that label numbering can be planned before touching the voxels.
+
+    Parameters
+    ----------
+    sources : dict
+        Mapping from source name to label volume (all volumes share the same shape).
+        If ``cache`` is given, a source can also be the path of the volume, in which
+        case its lookup keys and histogram are kept in the cache and shared with
+        the other remappers of the run.
+
+    cache : cmtklib.util.VolumeCache
+        Optional cache of the volumes loaded in the current run
+
+    bbox : cmtklib.util.BoundingBox
+        Optional box containing all the voxels to relabel. If given, the steps are
+        applied to the cropped volumes, ``add_indices`` takes full-grid indices and
+        ``apply`` expects the cropped shape.
+    """
+
+    def __init__(self, sources, cache=None, bbox=None):
+        self.sources = sources
+        self.cache = cache
+        self.bbox = bbox
+        self.steps = []
+        self.max_label = 0
+        self._keys = {}
+        self._hist = {}
+
+    def _full_keys(self, name):
+        source = self.sources[name]
+        if self.cache is not None and not isinstance(source, np.ndarray):
+            return self.cache.derived((op.abspath(source), 'label_keys'),
+                                      lambda: label_keys(self.cache.get_data(source)))
+        return label_keys(source)
+
+    def keys(self, name):
+        """ Returns the source volume (cropped to ``bbox``) as a non-negative integer array usable as a LUT index """
+        if name not in self._keys:
+            keys = self._full_keys(name)
+            self._keys[name] = keys if self.bbox is None else self.bbox.crop(keys)
+        return self._keys[name]
+
+    def histogram(self, name):
+        """ Returns the number of voxels of each label in the (full) source volume """
+        if name not in self._hist:
+            source = self.sources[name]
+            if self.cache is not None and not isinstance(source, np.ndarray):
+                self._hist[name] = self.cache.derived((op.abspath(source), 'label_histogram'),
+                                                      lambda: np.bincount(self._full_keys(name).ravel()))
+            else:
+                self._hist[name] = np.bincount(self._full_keys(name).ravel())
+        return self._hist[name]
+
+    def add(self, name, old_labels, new_labels):
+        """ Relabels voxels of source ``name`` from ``old_labels`` to ``new_labels``.
+
+        Returns the maximal label of the relabeled volume after this step.
+        """
+        old_labels = np.asarray(old_labels, dtype=np.int64).ravel()
+        new_labels = np.asarray(new_labels, dtype=np.int64).ravel()
+        self.steps.append((name, old_labels, new_labels))
+
+        hist = self.histogram(name)
+        inside = (old_labels >= 0) & (old_labels < hist.size)
+        present = np.zeros(old_labels.shape, dtype=bool)
+        present[inside] = hist[old_labels[inside]] > 0
+        if present.any():
+            self.max_label = int(new_labels[present].max())
+        return self.max_label
+
+    def add_indices(self, indices, label):
+        """ Sets voxels given by ``indices`` (as returned by ``np.where``) to ``label``.
+
+        Returns the maximal label of the relabeled volume after this step.
+        """
+        if self.bbox is not None and len(indices) > 0:
+            indices = self.bbox.crop_indices(indices)
+        self.steps.append((None, indices, int(label)))
+        if len(indices) > 0 and indices[0].size > 0:
+            self.max_label = int(label)
+        return self.max_label
+
+    def apply(self, shape, dtype=np.int16):
+        """ Applies all the steps and returns the relabeled volume and the rank
+        (1-based index in ``steps``) of the step that wrote each voxel (0 if none).
+        """
+        out = np.zeros(shape, dtype=dtype)
+        rank = np.zeros(shape, dtype=np.uint8 if len(self.steps) < 256 else np.uint16)
+
+        # Build one lookup table (label and rank) per source
+        tables = {}
+        for r, (name, old_labels, new_labels) in enumerate(self.steps, 1):
+            if name is None:
+                continue
+            if name not in tables:
+                n = self.histogram(name).size
+                tables[name] = (np.zeros(n, dtype=dtype), np.zeros(n, dtype=rank.dtype))
+            lut_label, lut_rank = tables[name]
+            inside = (old_labels >= 0) & (old_labels < lut_label.size)
+            lut_label[old_labels[inside]] = new_labels[inside]
+            lut_rank[old_labels[inside]] = r
+
+        # Ranks are compared voxel-wise so sources can be applied in any order
+        for name, (lut_label, lut_rank) in tables.items():
+            keys = self.keys(name)
+            vox_rank = lut_rank[keys]
+            upd = vox_rank > rank
+            out[upd] = lut_label[keys[upd]]
+            rank[upd] = vox_rank[upd]
+
+        for r, (name, indices, label) in enumerate(self.steps, 1):
+            if name is not None or len(indices) == 0:
+                continue
+            sel = rank[indices] < r
+            sub = tuple(ax[sel] for ax in indices)
+            out[sub] = label
+            rank[sub] = r
+
+        return out, rank
+
+class ParcellationNodeTable(object):
+    """ Table of the nodes (regions) of one scale of a parcellation.
+
+    Nodes are recorded by sections (groups of structures, e.g. the cortical regions
+    of one hemisphere) in label order and are serialized in bulk to a FreeSurfer
+    colorLUT, a GraphML file (with the region adjacency as optional edges) and a TSV file. The TSV file holds
+    all the columns of the table so that it can be read back with ``read_tsv``
+    and the other files regenerated without the parcellation images.
+    """
+
+    columns = ['index', 'name', 'region', 'fsname', 'hemisphere', 'fsID', 'R', 'G', 'B', 'section']
+
+    def __init__(self):
+        self.rows = []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, section, labels, names, region, fsnames, hemisphere, fs_ids, colors):
+        """ Adds the nodes of a section.
+
+        ``fsnames`` and ``fs_ids`` can be given by node or as a single value shared
+        by all the nodes of the section. ``colors`` is an array of RGB triplets,
+        or a single RGB triplet shared by all the nodes.
+        """
+        labels = np.atleast_1d(labels)
+        n = labels.shape[0]
+        if isinstance(fsnames, string_types):
+            fsnames = [fsnames] * n
+        fs_ids = np.broadcast_to(np.asarray(fs_ids), (n,))
+        colors = np.broadcast_to(np.asarray(colors), (n, 3))
+        self.rows.extend(zip([int(l) for l in labels], names, [region] * n, fsnames, [hemisphere] * n,
+                             [int(i) for i in fs_ids], [int(c) for c in colors[:, 0]],
+                             [int(c) for c in colors[:, 1]], [int(c) for c in colors[:, 2]], [section] * n))
+
+    def sections(self):
+        """ Returns the list of (section, rows) in the order they were added """
+        sections = []
+        for row in self.rows:
+            if len(sections) == 0 or sections[-1][0] != row[-1]:
+                sections.append((row[-1], []))
+            sections[-1][1].append(row)
+        return sections
+
+    def write_colorLUT(self, filename):
+        """ Writes the table as a FreeSurfer colorLUT file """
+        time_now = strftime("%a, %d %b %Y %H:%M:%S",localtime())
+        lines = ['#$Id: {} {} \n \n'.format(op.basename(filename),time_now),
+                 '{:<4} {:<55} {:>3} {:>3} {:>3} {} \n \n'.format("#No.","Label Name:","R","G","B","A")]
+        for section, rows in self.sections():
+            lines.append("# {} \n".format(section))
+            lines.extend(['{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(row[0],row[1],row[6],row[7],row[8]) for row in rows])
+            lines.append("\n")
+        with open(filename, 'w') as f:
+            f.write(''.join(lines))
+
+    def write_graphml(self, filename, edges=None):
+        """ Writes the table as the nodes of a GraphML file.
+
+        ``edges`` is an optional array of (label, label, number of shared voxel faces)
+        rows, as returned by ``compute_label_adjacency``. Edges between labels that are
+        not nodes of the table are ignored.
+        """
+        lines = ['{} \n'.format('<?xml version="1.0" encoding="utf-8"?>'),
+                 '{} \n'.format('<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'),
+                 '{} \n'.format('  <key attr.name="dn_region" attr.type="string" for="node" id="d0" />'),
+                 '{} \n'.format('  <key attr.name="dn_fsname" attr.type="string" for="node" id="d1" />'),
+                 '{} \n'.format('  <key attr.name="dn_hemisphere" attr.type="string" for="node" id="d2" />'),
+                 '{} \n'.format('  <key attr.name="dn_multiscaleID" attr.type="int" for="node" id="d3" />'),
+                 '{} \n'.format('  <key attr.name="dn_name" attr.type="string" for="node" id="d4" />'),
+                 '{} \n'.format('  <key attr.name="dn_fsID" attr.type="int" for="node" id="d5" />')]
+        if edges is not None:
+            lines.append('{} \n'.format('  <key attr.name="shared_voxel_faces" attr.type="int" for="edge" id="d6" />'))
+        lines.append('{} \n'.format('  <graph edgedefault="undirected" id="">'))
+        node_template = ('    <node id="%i"> \n'
+                         '      <data key="d0">%s</data> \n'
+                         '      <data key="d1">%s</data> \n'
+                         '      <data key="d2">%s</data> \n'
+                         '      <data key="d3">%i</data> \n'
+                         '      <data key="d4">%s</data> \n'
+                         '      <data key="d5">%i</data> \n'
+                         '    </node> \n')
+        lines.extend([node_template % (row[0], row[2], row[3], row[4], row[0], row[1], row[5]) for row in self.rows])
+        if edges is not None:
+            edges = np.asarray(edges).reshape(-1, 3)
+            node_labels = np.array([row[0] for row in self.rows], dtype=np.int64)
+            edges = edges[np.isin(edges[:, 0], node_labels) & np.isin(edges[:, 1], node_labels)]
+            edge_template = ('    <edge source="%i" target="%i"> \n'
+                             '      <data key="d6">%i</data> \n'
+                             '    </edge> \n')
+            lines.extend([edge_template % (u, v, w) for u, v, w in edges.tolist()])
+        lines.extend(['{} \n'.format('  </graph>'),
+                      '{} \n'.format('</graphml>')])
+        with open(filename, 'w') as f:
+            f.write(''.join(lines))
+
+    def write_tsv(self, filename):
+        """ Writes the table as a tab-separated file with a header line """
+        lines = ['\t'.join(self.columns) + '\n']
+        lines.extend(['\t'.join([str(v) for v in row]) + '\n' for row in self.rows])
+        with open(filename, 'w') as f:
+            f.write(''.join(lines))
+
+    @classmethod
+    def read_tsv(cls, filename):
+        """ Reads a table written by ``write_tsv`` """
+        table = cls()
+        with open(filename, 'r') as f:
+            header = f.readline().rstrip('\n').split('\t')
+            for line in f:
+                values = dict(zip(header, line.rstrip('\n').split('\t')))
+                table.rows.append((int(values['index']), values['name'], values['region'], values['fsname'],
+                                   values['hemisphere'], int(values['fsID']), int(values['R']),
+                                   int(values['G']), int(values['B']), values['section']))
+        return table
+
 class CombineParcellationsInputSpec(BaseInterfaceInputSpec):
     input_rois = InputMultiPath(File(exists=True))
     lh_hippocampal_subfields = File(' ')
@@ -315,6 +1071,11 @@ class CombineParcellationsInputSpec(BaseInterfaceInputSpec):
     subjects_dir = Directory(desc='Freesurfer subjects dir')
     subject_id = traits.Str(desc='Freesurfer subject id')
     verbose_level = traits.Enum(1,2,desc='verbose level (1: partial (default) / 2: full)')
+    create_node_table = traits.Bool(True)
+    number_of_cores = traits.Int(1,desc='Maximal number of scales processed in parallel')
+    create_debug_images = traits.Bool(False,desc='Save the differences between the FreeSurfer and the thalamic nuclei masks in <subject>/tmp')
+    skip_unchanged = traits.Bool(False,desc='Reuse the outputs of the previous run (kept in <subject>/tmp/lausanne2018) for the scales whose inputs and options are unchanged')
+    graphml_edges = traits.Bool(True,usedefault=True,desc='Add the voxel-face adjacency of the regions as edges of the GraphML files')
 
 class CombineParcellationsOutputSpec(TraitedSpec):
     aparc_aseg = File(exists=True)
@@ -322,6 +1083,7 @@ class CombineParcellationsOutputSpec(TraitedSpec):
     output_rois = OutputMultiPath(File(exists=True))
     colorLUT_files = OutputMultiPath(File(exists=True))
     graphML_files = OutputMultiPath(File(exists=True))
+    node_table_files = OutputMultiPath(File(exists=True))
 
 class CombineParcellations(BaseInterface):
     input_spec = CombineParcellationsInputSpec
@@ -344,6 +1106,9 @@ class CombineParcellations(BaseInterface):
         fs_dir = op.join(self.inputs.subjects_dir,self.inputs.subject_id)
         iflogger.info("  > Freesurfer subject directory: {}".format(fs_dir))
 
+        # Volumes and derived masks shared by all the scales are loaded/computed only once
+        cache = VolumeCache()
+
         # Freesurfer IDs for subcortical structures
         left_subcIds = np.array([10, 11, 12, 13, 26, 18, 17])
         left_subcIds_colors_r = np.array([0, 122, 236, 12, 255, 103, 220])
@@ -375,15 +1140,13 @@ class CombineParcellations(BaseInterface):
         left_thalNuclei_colors_r = np.array([255, 0, 255, 255, 0, 255, 0])
         left_thalNuclei_colors_g = np.array([0, 255, 255, 123, 255, 0, 0])
         left_thalNuclei_colors_b = np.array([0, 0, 0, 0, 255, 255, 255])
-        left_thalNuclei_names = ["Left-Pulvinar","Left-Anterior","Left-Medio_Dorsal","Left-Ventral_Latero_Dorsal","Left-Central_Lateral-Lateral_Posterior-Medial_Pulvinar",
-                                 "Left-Ventral_Anterior","Left-Ventral_Latero_Ventral"]
+        left_thalNuclei_names = THALAMIC_NUCLEI_NAMES[:7]
 
         right_thalNuclei = np.array([8, 9, 10, 11, 12, 13, 14])
         right_thalNuclei_colors_r = np.array([255, 0, 255, 255, 0, 255, 0])
         right_thalNuclei_colors_g = np.array([0, 255, 255, 123, 255, 0, 0])
         right_thalNuclei_colors_b = np.array([0, 0, 0, 0, 255, 255, 255])
-        right_thalNuclei_names = ["Right-Pulvinar","Right-Anterior","Right-Medio_Dorsal","Right-Ventral_Latero_Dorsal","Right-Central_Lateral-Lateral_Posterior-Medial_Pulvinar",
-                                  "Right-Ventral_Anterior","Right-Ventral_Latero_Ventral"]
+        right_thalNuclei_names = THALAMIC_NUCLEI_NAMES[7:]
 
 
         # Hippocampus subfields
@@ -433,16 +1196,16 @@ class CombineParcellations(BaseInterface):
         lh_subfield_defined = False
         # Reading Subfields Images
         try:
-            Vsublh = ni.load(self.inputs.lh_hippocampal_subfields)
-            Isublh = Vsublh.get_data()
+            Vsublh = cache.load(self.inputs.lh_hippocampal_subfields)
+            Isublh = cache.get_data(self.inputs.lh_hippocampal_subfields)
             lh_subfield_defined = True
         except TypeError:
             iflogger.info(bcolors.WARNING + '  Subfields image (Left hemisphere) not provided' + bcolors.ENDC)
 
         rh_subfield_defined = False
         try:
-            Vsubrh =  ni.load(self.inputs.rh_hippocampal_subfields)
-            Isubrh = Vsubrh.get_data()
+            Vsubrh = cache.load(self.inputs.rh_hippocampal_subfields)
+            Isubrh = cache.get_data(self.inputs.rh_hippocampal_subfields)
             rh_subfield_defined = True
         except TypeError:
             iflogger.info(bcolors.WARNING + '  Subfields image (Right hemisphere) not provided' + bcolors.ENDC)
@@ -451,8 +1214,8 @@ class CombineParcellations(BaseInterface):
         thalamus_nuclei_defined = False
         # Reading  Nuclei
         try:
-            Vthal = ni.load(self.inputs.thalamus_nuclei)
-            Ithal = Vthal.get_data()
+            Vthal = cache.load(self.inputs.thalamus_nuclei)
+            Ithal = cache.get_data(self.inputs.thalamus_nuclei)
 
             thalamus_nuclei_defined = True
         except TypeError:
@@ -461,9 +1224,9 @@ class CombineParcellations(BaseInterface):
         brainstem_defined = False
         # Reading Stem Image
         try:
-            Vstem = ni.load(self.inputs.brainstem_structures)
-            Istem = Vstem.get_data()
-            indstem = np.where(Istem > 0)
+            Vstem = cache.load(self.inputs.brainstem_structures)
+            Istem = cache.get_data(self.inputs.brainstem_structures)
+            indstem = cache.derived('indstem', lambda: np.where(Istem > 0))
             brainstem_defined = True
         except TypeError:
             iflogger.info(bcolors.WARNING + '  Brain stem image not provided' + bcolors.ENDC)
@@ -496,590 +1259,209 @@ class CombineParcellations(BaseInterface):
                 break
 
         iflogger.info("  > Create ventricule image")
-        V = ni.load(roi1_fname)
-        I = V.get_data()
-        tmp = np.zeros(I.shape)
-        indV = np.where(I == ventricle3)
-        tmp[indV] = 1
-
-        thirdV = op.abspath('{}.nii.gz'.format("ventricle3"))
-        hdr = V.get_header()
-        hdr2 = hdr.copy()
-        hdr2.set_data_dtype(np.int16)
-        iflogger.info("    ... Image saved to {}".format(thirdV))
-        img = ni.Nifti1Image(tmp, V.get_affine(), hdr2)
-        ni.save(img, thirdV)
+        V = cache.load(roi1_fname)
+        I = cache.get_data(roi1_fname)
+        thirdV = (I == ventricle3)
 
+        # Spherical dilation of 5mm (as fslmaths -kernel sphere 5 -dilD), done in the bounding box of the ventricle
         iflogger.info("  > Dilate the ventricule image")
-        thirdV_dil = op.abspath('{}_dil.nii.gz'.format("ventricle3"))
-        fslmaths_cmd = 'fslmaths {} -kernel sphere 5 -dilD {}'.format(thirdV,thirdV_dil)
-        iflogger.info("    ... Command: {}".format(fslmaths_cmd))
-        process = subprocess.Popen(fslmaths_cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-        proc_stdout = process.communicate()[0].strip()
-
-        tmp = ni.load(thirdV_dil).get_data()
-        indrhypothal = np.where((tmp == 1) & (I == right_ventral))
-        indlhypothal = np.where((tmp == 1) & (I == left_ventral))
-        del(tmp)
-
-        f_colorLUT = None
-        f_graphML = None
-
-        for roi_index, roi in sorted(enumerate(self.inputs.input_rois)):
-            # colorLUT creation if enabled
-            if self.inputs.create_colorLUT:
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                colorLUT_file = op.abspath('{}_FreeSurferColorLUT.txt'.format(outprefixName))
-                iflogger.info("  > Create colorLUT file as %s" % colorLUT_file)
-                f_colorLUT = open(colorLUT_file,'w+')
-                time_now = strftime("%a, %d %b %Y %H:%M:%S",localtime())
-                hdr_lines = ['#$Id: {}_FreeSurferColorLUT.txt {} \n \n'.format(outprefixName,time_now),
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} {} \n \n'.format("#No.","Label Name:","R","G","B","A")]
-                f_colorLUT.writelines (hdr_lines)
-                del hdr_lines
-
-            # Create GraphML if enabled
-            if self.inputs.create_graphml:
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                graphML_file = op.abspath('{}.graphml'.format(outprefixName))
-                iflogger.info("  > Create graphML_file as {}".format(graphML_file))
-                f_graphML = open(graphML_file,'w+')
-
-                hdr_lines = ['{} \n'.format('<?xml version="1.0" encoding="utf-8"?>'),
-                             '{} \n'.format('<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'),
-                             '{} \n'.format('  <key attr.name="dn_region" attr.type="string" for="node" id="d0" />'),
-                             '{} \n'.format('  <key attr.name="dn_fsname" attr.type="string" for="node" id="d1" />'),
-                             '{} \n'.format('  <key attr.name="dn_hemisphere" attr.type="string" for="node" id="d2" />'),
-                             '{} \n'.format('  <key attr.name="dn_multiscaleID" attr.type="int" for="node" id="d3" />'),
-                             '{} \n'.format('  <key attr.name="dn_name" attr.type="string" for="node" id="d4" />'),
-                             '{} \n'.format('  <key attr.name="dn_fsID" attr.type="int" for="node" id="d5" />'),
-                             '{} \n'.format('  <graph edgedefault="undirected" id="">'),]
-                f_graphML.writelines (hdr_lines)
-                del hdr_lines
-
-            # Reading Cortical Parcellation
-            V = ni.load(roi)
-            I = V.get_data()
-
-            # Replacing the brain stem (Stem is replaced by its own parcellation. Mismatch between both global volumes, mainly due to partial volume effect in the global stem parcellation)
-            indrep = np.where(I == 16)
-            I[indrep] = 0
+        tmp = dilate_mask_sphere(thirdV, 5, V.get_header().get_zooms()[:3])
+        indrhypothal = cache.derived('indrhypothal', lambda: np.where(tmp & (I == right_ventral)))
+        indlhypothal = cache.derived('indlhypothal', lambda: np.where(tmp & (I == left_ventral)))
+
+        # Volumes relabelled at every scale, given by path so that their lookup keys are cached
+        static_sources = {}
+        if thalamus_nuclei_defined:
+            static_sources['thalamus'] = self.inputs.thalamus_nuclei
+        if rh_subfield_defined:
+            static_sources['rh_subfields'] = self.inputs.rh_hippocampal_subfields
+        if lh_subfield_defined:
+            static_sources['lh_subfields'] = self.inputs.lh_hippocampal_subfields
+        if brainstem_defined:
+            static_sources['brainstem'] = self.inputs.brainstem_structures
+
+        def combine_single_scale(roi, writer):
+            outprefixName = roi.split(".")[0]
+            outprefixName = outprefixName.split("/")[-1:][0]
+            for elem in outprefixName.split("_"):
+                if "scale" in elem:
+                    scale = elem
+
+            # Reading Cortical Parcellation (scale1 is already in the cache)
+            V = cache.load(roi)
+            I = cache.get_data(roi)
+
+            # All relabelling steps below are only recorded and applied at once after the last one.
+            # The nodes of the new labels are recorded in the node table, written at the end.
+            sources = dict(static_sources)
+            sources['roi'] = I
+
+            # Relabelling is done in the box containing all labelled voxels and pasted back at save time
+            bbox = BoundingBox.from_mask(I)
+            for src in static_sources.values():
+                bbox = bbox.union(cache.derived((op.abspath(src), 'bounding_box'),
+                                                lambda: BoundingBox.from_mask(cache.get_data(src))))
+            bbox = bbox.union(BoundingBox.from_indices(I.shape, indrhypothal))
+            bbox = bbox.union(BoundingBox.from_indices(I.shape, indlhypothal))
+            if bbox.is_empty():
+                bbox = BoundingBox.full(I.shape)
+
+            remapper = LabelRemapper(sources, cache=cache, bbox=bbox)
+            nodes = ParcellationNodeTable()
 
             ## Processing Right Hemisphere
 
             # Relabelling Right hemisphere
-            It = np.zeros(I.shape,dtype=np.int16)
-            ind = np.where((I >= 2000) & (I < 3000))
-            It[ind] = (I[ind] - 2000)
-            nlabel = It.max()
-
-            #ColorLUT (cortical)
-            if self.inputs.create_colorLUT or self.inputs.create_graphml:
-                f_colorLUT.write("# Right Hemisphere. Cortical Structures \n")
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                for elem in outprefixName.split("_"):
-                    if "scale" in elem:
-                        scale = elem
-                rh_annot_file = 'rh.lausanne2008.%s.annot'%scale
-                iflogger.info("  > Load {}".format(rh_annot_file))
-                rh_annot = ni.freesurfer.io.read_annot(op.join(self.inputs.subjects_dir,self.inputs.subject_id,'label',rh_annot_file))
-                rgb_table = rh_annot[1][1:,0:3]
-                roi_names = rh_annot[2][1:]
-                #roi_labels = rh_annot[0][1:]
-
-                lines = []
-                for label, name in enumerate(roi_names):
-                    name = 'ctx-rh-{}'.format(name)
-                    if self.inputs.create_colorLUT:
-                        r = rgb_table[label,0]
-                        g = rgb_table[label,1]
-                        b = rgb_table[label,2]
-
-                        if label == 0:
-                            r = 0
-                            g = 0
-                            b = 0
-
-                        f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(label+1,name,r,g,b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">'%(label+1)),
-                                     '{} \n'.format('      <data key="d0">%s</data>'%("cortical")),
-                                     '{} \n'.format('      <data key="d1">%s</data>'%(name)),
-                                     '{} \n'.format('      <data key="d2">%s</data>'%("right")),
-                                     '{} \n'.format('      <data key="d3">%i</data>'%(label+1)),
-                                     '{} \n'.format('      <data key="d4">%s</data>'%(name)),
-                                     '{} \n'.format('      <data key="d5">%i</data>'%(int(label+2000+1))),
-                                     '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-
-
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+            nlabel = remapper.add('roi', np.arange(2000, 3000), np.arange(0, 1000))
+
+            rh_annot_file = 'rh.lausanne2008.%s.annot'%scale
+            iflogger.info("  > Load {}".format(rh_annot_file))
+            rh_annot = ni.freesurfer.io.read_annot(op.join(self.inputs.subjects_dir,self.inputs.subject_id,'label',rh_annot_file))
+            rgb_table = np.array(rh_annot[1][1:,0:3])
+            rgb_table[0] = 0
+            roi_names = ['ctx-rh-{}'.format(name) for name in rh_annot[2][1:]]
+            labels = np.arange(len(roi_names))
+            nodes.add("Right Hemisphere. Cortical Structures", labels+1, roi_names, "cortical", roi_names, "right", labels+2000+1, rgb_table)
 
             # Relabelling Thalamic Nuclei
             if thalamus_nuclei_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Right Hemisphere. Subcortical Structures (Thalamic Nuclei) \n")
-
                 newLabels = np.arange(nlabel+1,nlabel+1+right_thalNuclei.shape[0])
-                
-                i=0
-                for lab in right_thalNuclei:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update right thalamic nucleus label ({} -> {})".format(lab,newLabels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        r = right_thalNuclei_colors_r[i]
-                        g = right_thalNuclei_colors_g[i]
-                        b = right_thalNuclei_colors_b[i]
-                        f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]),right_thalNuclei_names[i],r,g,b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                     '{} \n'.format('      <data key="d1">%s</data>'%("thalamus")),
-                                     '{} \n'.format('      <data key="d2">%s</data>'%("right")),
-                                     '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d4">%s</data>'%(right_thalNuclei_names[i])),
-                                     '{} \n'.format('      <data key="d5">%i</data>'%(int(49))),
-                                     '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-
-                    ind = np.where(Ithal == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
-
-            # Relabelling Subcortical Structures
-            if self.inputs.create_colorLUT:
-                f_colorLUT.write("# Right Hemisphere. Subcortical Structures \n")
-
-            newLabels = np.arange(nlabel+1,nlabel+1+left_subc_labels.shape[0])
-
-            i=0
-            for lab in right_subc_labels:
                 if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update right subcortical label ({} -> {})".format(lab,newLabels[i]))
-
-                if self.inputs.create_colorLUT:
-                    r = right_subcIds_colors_r[i]
-                    g = right_subcIds_colors_g[i]
-                    b = right_subcIds_colors_b[i]
-                    f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]),right_subcort_names[i],r,g,b))
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[i]))),
-                                 '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                 '{} \n'.format('      <data key="d1">%s</data>'%("subcortical")),
-                                 '{} \n'.format('      <data key="d2">%s</data>'%("right")),
-                                 '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[i]))),
-                                 '{} \n'.format('      <data key="d4">%s</data>'%(right_subcort_names[i])),
-                                 '{} \n'.format('      <data key="d5">%i</data>'%(int(lab))),
-                                 '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
-
-                ind = np.where(I == lab)
-                It[ind] = newLabels[i]
-                i += 1
-            nlabel = It.max()
+                    for lab, newLabel in zip(right_thalNuclei, newLabels):
+                        iflogger.info("  > Update right thalamic nucleus label ({} -> {})".format(lab,newLabel))
+                nodes.add("Right Hemisphere. Subcortical Structures (Thalamic Nuclei)", newLabels, right_thalNuclei_names, "subcortical", "thalamus", "right", 49,
+                          np.c_[right_thalNuclei_colors_r, right_thalNuclei_colors_g, right_thalNuclei_colors_b])
+                nlabel = remapper.add('thalamus', right_thalNuclei, newLabels)
 
-            if self.inputs.create_colorLUT:
-                f_colorLUT.write("\n")
+            # Relabelling Subcortical Structures
+            newLabels = np.arange(nlabel+1,nlabel+1+right_subc_labels.shape[0])
+            if self.inputs.verbose_level == 2:
+                for lab, newLabel in zip(right_subc_labels, newLabels):
+                    iflogger.info("  > Update right subcortical label ({} -> {})".format(lab,newLabel))
+            nodes.add("Right Hemisphere. Subcortical Structures", newLabels, right_subcort_names, "subcortical", "subcortical", "right", right_subc_labels,
+                      np.c_[right_subcIds_colors_r, right_subcIds_colors_g, right_subcIds_colors_b][:right_subc_labels.shape[0]])
+            nlabel = remapper.add('roi', right_subc_labels, newLabels)
 
             # Relabelling Subfields
             if rh_subfield_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Right Hemisphere. Subcortical Structures (Hippocampal Subfields) \n")
-
                 newLabels = np.arange(nlabel+1,nlabel+1+hippo_subf.shape[0])
-                i=0
-                for lab in hippo_subf:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update right hippo subfield label ({} -> {})".format(lab,newLabels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        # if len(ind) > 0:
-                            r = hippo_subf_colors_r[i]
-                            g = hippo_subf_colors_g[i]
-                            b = hippo_subf_colors_b[i]
-                            f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]),right_hippo_subf_names[i],r,g,b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                     '{} \n'.format('      <data key="d1">%s</data>'%("hippocampus")),
-                                     '{} \n'.format('      <data key="d2">%s</data>'%("right")),
-                                     '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d4">%s</data>'%(right_hippo_subf_names[i])),
-                                     '{} \n'.format('      <data key="d5">%i</data>'%(int(lab))),
-                                     '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-
-                    ind = np.where(Isubrh == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                if self.inputs.verbose_level == 2:
+                    for lab, newLabel in zip(hippo_subf, newLabels):
+                        iflogger.info("  > Update right hippo subfield label ({} -> {})".format(lab,newLabel))
+                nodes.add("Right Hemisphere. Subcortical Structures (Hippocampal Subfields)", newLabels, right_hippo_subf_names, "subcortical", "hippocampus", "right", hippo_subf,
+                          np.c_[hippo_subf_colors_r, hippo_subf_colors_g, hippo_subf_colors_b])
+                nlabel = remapper.add('rh_subfields', hippo_subf, newLabels)
 
             if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
                 # Relabelling Right VentralDC
                 newLabels = np.arange(nlabel+1,nlabel+2)
                 if self.inputs.verbose_level == 2:
                     iflogger.info("  > Update right ventral DC label ({} -> {})".format(right_ventral,newLabels[0]))
-                ind = np.where(I == right_ventral)
-                It[ind] = newLabels[0]
-                nlabel = It.max()
-
-                #ColorLUT (right ventral DC)
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Right Hemisphere. Ventral Diencephalon \n")
-                    r = right_ventral_colors_r
-                    g = right_ventral_colors_g
-                    b = right_ventral_colors_b
-                    f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]),right_ventral_names[0],r,g,b))
-                    f_colorLUT.write("\n")
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[0]))),
-                                 '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                 '{} \n'.format('      <data key="d1">%s</data>'%("ventral-diencephalon")),
-                                 '{} \n'.format('      <data key="d2">%s</data>'%("right")),
-                                 '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[0]))),
-                                 '{} \n'.format('      <data key="d4">%s</data>'%(right_ventral_names[0])),
-                                 '{} \n'.format('      <data key="d5">%i</data>'%(int(right_ventral))),
-                                 '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
+                nodes.add("Right Hemisphere. Ventral Diencephalon", newLabels, right_ventral_names, "subcortical", "ventral-diencephalon", "right", right_ventral,
+                          [right_ventral_colors_r, right_ventral_colors_g, right_ventral_colors_b])
+                nlabel = remapper.add('roi', [right_ventral], newLabels)
 
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
                 # Relabelling Right Hypothalamus
                 newLabels = np.arange(nlabel+1,nlabel+2)
                 if self.inputs.verbose_level == 2:
                     iflogger.info("  > Update right hypothalamus label ({} -> {})".format(right_ventral,newLabels[0]))
-                It[indrhypothal] = newLabels[0]
-                nlabel = It.max()
-
-                #ColorLUT (right hypothalamus)
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Right Hemisphere. Hypothalamus \n")
-                    r = hypothal_colors_r
-                    g = hypothal_colors_g
-                    b = hypothal_colors_b
-                    f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]),right_hypothal_names[0],r,g,b))
-                    f_colorLUT.write("\n")
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[0]))),
-                                 '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                 '{} \n'.format('      <data key="d1">%s</data>'%("hypothalamus")),
-                                 '{} \n'.format('      <data key="d2">%s</data>'%("right")),
-                                 '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[0]))),
-                                 '{} \n'.format('      <data key="d4">%s</data>'%(right_hypothal_names[0])),
-                                 '{} \n'.format('      <data key="d5">%i</data>'%(-1)),
-                                 '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
+                nodes.add("Right Hemisphere. Hypothalamus", newLabels, right_hypothal_names, "subcortical", "hypothalamus", "right", -1,
+                          [hypothal_colors_r, hypothal_colors_g, hypothal_colors_b])
+                nlabel = remapper.add_indices(indrhypothal, newLabels[0])
 
             ## Processing Left Hemisphere
             # Relabelling Left hemisphere
-            ind = np.where((I > 1000) & (I <2000))
-            It[ind] = (I[ind] - 1000 + nlabel)
             old_nlabel = nlabel
-            nlabel = It.max()
-
-            #ColorLUT (cortical)
-            if self.inputs.create_colorLUT or self.inputs.create_graphml:
-                f_colorLUT.write("# Left Hemisphere. Cortical Structures \n")
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                for elem in outprefixName.split("_"):
-                    if "scale" in elem:
-                        scale = elem
-                lh_annot_file = 'lh.lausanne2008.%s.annot'%scale
-                iflogger.info("  > Load {}".format(lh_annot_file))
-                lh_annot = ni.freesurfer.io.read_annot(op.join(self.inputs.subjects_dir,self.inputs.subject_id,'label',lh_annot_file))
-                rgb_table = lh_annot[1][1:,0:3]
-                roi_names = lh_annot[2][1:]
-
-                lines = []
-                for label, name in enumerate(roi_names):
-                    name = 'ctx-lh-{}'.format(name)
-
-                    if self.inputs.create_colorLUT:
-                        r = rgb_table[label,0]
-                        g = rgb_table[label,1]
-                        b = rgb_table[label,2]
-
-                        if label == 0:
-                            r = 0
-                            g = 0
-                            b = 0
-
-                        f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(label+old_nlabel+1),name,r,g,b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">'%(int(label+old_nlabel+1))),
-                                     '{} \n'.format('      <data key="d0">%s</data>'%("cortical")),
-                                     '{} \n'.format('      <data key="d1">%s</data>'%(name)),
-                                     '{} \n'.format('      <data key="d2">%s</data>'%("left")),
-                                     '{} \n'.format('      <data key="d3">%i</data>'%(int(label+old_nlabel+1))),
-                                     '{} \n'.format('      <data key="d4">%s</data>'%(name)),
-                                     '{} \n'.format('      <data key="d5">%i</data>'%(int(label + 1000 - old_nlabel))),
-                                     '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+            nlabel = remapper.add('roi', np.arange(1001, 2000), np.arange(1, 1000) + old_nlabel)
+
+            lh_annot_file = 'lh.lausanne2008.%s.annot'%scale
+            iflogger.info("  > Load {}".format(lh_annot_file))
+            lh_annot = ni.freesurfer.io.read_annot(op.join(self.inputs.subjects_dir,self.inputs.subject_id,'label',lh_annot_file))
+            rgb_table = np.array(lh_annot[1][1:,0:3])
+            rgb_table[0] = 0
+            roi_names = ['ctx-lh-{}'.format(name) for name in lh_annot[2][1:]]
+            labels = np.arange(len(roi_names))
+            nodes.add("Left Hemisphere. Cortical Structures", labels+old_nlabel+1, roi_names, "cortical", roi_names, "left", labels+1000-old_nlabel, rgb_table)
 
             # Relabelling Thalamic Nuclei
             if thalamus_nuclei_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Left Hemisphere. Subcortical Structures (Thalamic Nuclei) \n")
-
                 newLabels = np.arange(nlabel+1,nlabel+1+left_thalNuclei.shape[0])
-                i=0
-                for lab in left_thalNuclei:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update left thalamic nucleus label ({} -> {})".format(lab,newLabels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        r = left_thalNuclei_colors_r[i]
-                        g = left_thalNuclei_colors_g[i]
-                        b = left_thalNuclei_colors_b[i]
-                        f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]),left_thalNuclei_names[i],r,g,b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                     '{} \n'.format('      <data key="d1">%s</data>'%("thalamus")),
-                                     '{} \n'.format('      <data key="d2">%s</data>'%("left")),
-                                     '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d4">%s</data>'%(left_thalNuclei_names[i])),
-                                     '{} \n'.format('      <data key="d5">%i</data>'%(int(10))),
-                                     '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-
-                    ind = np.where(Ithal == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                if self.inputs.verbose_level == 2:
+                    for lab, newLabel in zip(left_thalNuclei, newLabels):
+                        iflogger.info("  > Update left thalamic nucleus label ({} -> {})".format(lab,newLabel))
+                nodes.add("Left Hemisphere. Subcortical Structures (Thalamic Nuclei)", newLabels, left_thalNuclei_names, "subcortical", "thalamus", "left", 10,
+                          np.c_[left_thalNuclei_colors_r, left_thalNuclei_colors_g, left_thalNuclei_colors_b])
+                nlabel = remapper.add('thalamus', left_thalNuclei, newLabels)
 
             # Relabelling Subcortical Structures
-            if self.inputs.create_colorLUT:
-                f_colorLUT.write("# Left Hemisphere. Subcortical Structures \n")
-
             newLabels = np.arange(nlabel+1,nlabel+1+left_subc_labels.shape[0])
-
-            i=0
-            for lab in left_subc_labels:
-                if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update left subcortical label ({} -> {})".format(lab,newLabels[i]))
-
-                if self.inputs.create_colorLUT:
-                    r = left_subcIds_colors_r[i]
-                    g = left_subcIds_colors_g[i]
-                    b = left_subcIds_colors_b[i]
-                    f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]),left_subcort_names[i],r,g,b))
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[i]))),
-                                 '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                 '{} \n'.format('      <data key="d1">%s</data>'%("subcortical")),
-                                 '{} \n'.format('      <data key="d2">%s</data>'%("left")),
-                                 '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[i]))),
-                                 '{} \n'.format('      <data key="d4">%s</data>'%(left_subcort_names[i])),
-                                 '{} \n'.format('      <data key="d5">%i</data>'%(int(lab))),
-                                 '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
-
-                ind = np.where(I == lab)
-                It[ind] = newLabels[i]
-                i += 1
-            nlabel = It.max()
-
-            if self.inputs.create_colorLUT:
-                f_colorLUT.write("\n")
+            if self.inputs.verbose_level == 2:
+                for lab, newLabel in zip(left_subc_labels, newLabels):
+                    iflogger.info("  > Update left subcortical label ({} -> {})".format(lab,newLabel))
+            nodes.add("Left Hemisphere. Subcortical Structures", newLabels, left_subcort_names, "subcortical", "subcortical", "left", left_subc_labels,
+                      np.c_[left_subcIds_colors_r, left_subcIds_colors_g, left_subcIds_colors_b][:left_subc_labels.shape[0]])
+            nlabel = remapper.add('roi', left_subc_labels, newLabels)
 
             # Relabelling Subfields
             if lh_subfield_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Left Hemisphere. Subcortical Structures (Hippocampal Subfields) \n")
-
                 newLabels = np.arange(nlabel+1,nlabel+1+hippo_subf.shape[0])
-                i=0
-                for lab in hippo_subf:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update left hippo subfield label ({} -> {})".format(lab,newLabels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        r = hippo_subf_colors_r[i]
-                        g = hippo_subf_colors_g[i]
-                        b = hippo_subf_colors_b[i]
-                        f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]),left_hippo_subf_names[i],r,g,b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                     '{} \n'.format('      <data key="d1">%s</data>'%("hippocampus")),
-                                     '{} \n'.format('      <data key="d2">%s</data>'%("left")),
-                                     '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d4">%s</data>'%(left_hippo_subf_names[i])),
-                                     '{} \n'.format('      <data key="d5">%i</data>'%(int(lab))),
-                                     '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-
-                    ind = np.where(Isublh == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-                newIds_LH_subFields = newLabels
-
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                if self.inputs.verbose_level == 2:
+                    for lab, newLabel in zip(hippo_subf, newLabels):
+                        iflogger.info("  > Update left hippo subfield label ({} -> {})".format(lab,newLabel))
+                nodes.add("Left Hemisphere. Subcortical Structures (Hippocampal Subfields)", newLabels, left_hippo_subf_names, "subcortical", "hippocampus", "left", hippo_subf,
+                          np.c_[hippo_subf_colors_r, hippo_subf_colors_g, hippo_subf_colors_b])
+                nlabel = remapper.add('lh_subfields', hippo_subf, newLabels)
 
             if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
                 # Relabelling Left VentralDC
                 newLabels = np.arange(nlabel+1,nlabel+2)
                 if self.inputs.verbose_level == 2:
                     iflogger.info("  > Update left ventral DC label ({} -> {})".format(left_ventral,newLabels[0]))
-                ind = np.where(I == left_ventral)
-                It[ind] = newLabels[0]
-                nlabel = It.max()
-                newIds_LH_ventralDC = newLabels;
-
-                #ColorLUT (left ventral DC)
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Left Hemisphere. Ventral Diencephalon \n")
-                    r = left_ventral_colors_r
-                    g = left_ventral_colors_g
-                    b = left_ventral_colors_b
-                    f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]),left_ventral_names[0],r,g,b))
-                    f_colorLUT.write("\n")
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[0]))),
-                                 '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                 '{} \n'.format('      <data key="d1">%s</data>'%("ventral-diencephalon")),
-                                 '{} \n'.format('      <data key="d2">%s</data>'%("left")),
-                                 '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[0]))),
-                                 '{} \n'.format('      <data key="d4">%s</data>'%(left_ventral_names[0])),
-                                 '{} \n'.format('      <data key="d5">%i</data>'%(int(left_ventral))),
-                                 '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
+                nodes.add("Left Hemisphere. Ventral Diencephalon", newLabels, left_ventral_names, "subcortical", "ventral-diencephalon", "left", left_ventral,
+                          [left_ventral_colors_r, left_ventral_colors_g, left_ventral_colors_b])
+                nlabel = remapper.add('roi', [left_ventral], newLabels)
 
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
                 # Relabelling Left Hypothalamus
                 newLabels = np.arange(nlabel+1,nlabel+2)
                 if self.inputs.verbose_level == 2:
                     iflogger.info("  > Update left hypothalamus label ({} -> {})".format(-1,newLabels[0]))
-                It[indlhypothal] = newLabels[0]
-                nlabel = It.max()
-
-                #ColorLUT (right hypothalamus)
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Left Hemisphere. Hypothalamus \n")
-                    r = hypothal_colors_r
-                    g = hypothal_colors_g
-                    b = hypothal_colors_b
-                    f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]),left_hypothal_names[0],r,g,b))
-                    f_colorLUT.write("\n")
-
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[0]))),
-                                 '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                 '{} \n'.format('      <data key="d1">%s</data>'%("hypothalamus")),
-                                 '{} \n'.format('      <data key="d2">%s</data>'%("left")),
-                                 '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[0]))),
-                                 '{} \n'.format('      <data key="d4">%s</data>'%(left_hypothal_names[0])),
-                                 '{} \n'.format('      <data key="d5">%i</data>'%(-1)),
-                                 '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
-
-            if scale == 'scale1':
-                gmMask = It.copy()
+                nodes.add("Left Hemisphere. Hypothalamus", newLabels, left_hypothal_names, "subcortical", "hypothalamus", "left", -1,
+                          [hypothal_colors_r, hypothal_colors_g, hypothal_colors_b])
+                nlabel = remapper.add_indices(indlhypothal, newLabels[0])
 
-            # Relabelling Brain Stem
+            # Relabelling Brain Stem (the rank of the step is kept to exclude the brain stem from the GM mask)
             if brainstem_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Brain Stem Structures \n")
-
                 newLabels = np.arange(nlabel+1,nlabel+1+brainstem.shape[0])
-                i=0
-                for lab in brainstem:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update brainstem parcellation label ({} -> {})".format(lab,newLabels[i]))
-
-                    if self.inputs.create_colorLUT:
-                        r = brainstem_colors_r[i]
-                        g = brainstem_colors_g[i]
-                        b = brainstem_colors_b[i]
-                        f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]),brainstem_names[i],r,g,b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                     '{} \n'.format('      <data key="d1">%s</data>'%("brainstem")),
-                                     '{} \n'.format('      <data key="d2">%s</data>'%("central")),
-                                     '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[i]))),
-                                     '{} \n'.format('      <data key="d4">%s</data>'%(brainstem_names[i])),
-                                     '{} \n'.format('      <data key="d5">%i</data>'%(int(lab))),
-                                     '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-
-                    ind = np.where(Istem == lab)
-                    It[ind] = newLabels[i]
-                    if scale == 'scale1':
-                        gmMask[ind] = 0
-                    i += 1
-                nlabel = It.max()
-
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                if self.inputs.verbose_level == 2:
+                    for lab, newLabel in zip(brainstem, newLabels):
+                        iflogger.info("  > Update brainstem parcellation label ({} -> {})".format(lab,newLabel))
+                nodes.add("Brain Stem Structures", newLabels, brainstem_names, "subcortical", "brainstem", "central", brainstem,
+                          np.c_[brainstem_colors_r, brainstem_colors_g, brainstem_colors_b])
+                nlabel = remapper.add('brainstem', brainstem, newLabels)
+                brainstem_rank = len(remapper.steps)
             else:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Brain Stem \n")
-
+                # Replacing the brain stem (Stem is replaced by its own parcellation. Mismatch between both global volumes, mainly due to partial volume effect in the global stem parcellation)
                 newLabels = np.arange(nlabel+1,nlabel+2)
-                It[indrep] = newLabels[0]
-
-                if scale == 'scale1':
-                    gmMask[indrep] = 0
-
                 if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update brainstem parcellation label ({} -> {})".format(lab,newLabels[0]))
-
-                if self.inputs.create_colorLUT:
-                    r = 119
-                    g = 159
-                    b = 176
-                    f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]),'brainstem',r,g,b))
-
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">'%(int(newLabels[0]))),
-                                     '{} \n'.format('      <data key="d0">%s</data>'%("subcortical")),
-                                     '{} \n'.format('      <data key="d1">%s</data>'%("brainstem")),
-                                     '{} \n'.format('      <data key="d2">%s</data>'%("central")),
-                                     '{} \n'.format('      <data key="d3">%i</data>'%(int(newLabels[0]))),
-                                     '{} \n'.format('      <data key="d4">%s</data>'%("brainstem")),
-                                     '{} \n'.format('      <data key="d5">%i</data>'%(int(lab))),
-                                     '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
+                    iflogger.info("  > Update brainstem parcellation label ({} -> {})".format(16,newLabels[0]))
+                nodes.add("Brain Stem", newLabels, ["brainstem"], "subcortical", "brainstem", "central", 16, [119, 159, 176])
+                nlabel = remapper.add('roi', [16], newLabels)
+                brainstem_rank = len(remapper.steps)
 
-                nlabel = It.max()
+            # colorLUT creation if enabled
+            if self.inputs.create_colorLUT:
+                colorLUT_file = op.abspath('{}_FreeSurferColorLUT.txt'.format(outprefixName))
+                iflogger.info("  > Create colorLUT file as %s" % colorLUT_file)
+                nodes.write_colorLUT(colorLUT_file)
 
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+            # Create node table (TSV) if enabled
+            if self.inputs.create_node_table:
+                node_table_file = op.abspath('{}_nodes.tsv'.format(outprefixName))
+                iflogger.info("  > Create node table as {}".format(node_table_file))
+                nodes.write_tsv(node_table_file)
 
+            iflogger.info("  > Apply {} relabelling steps".format(len(remapper.steps)))
+            It, written_by = remapper.apply(bbox.cropped_shape, dtype=np.int16)
 
             hdr = V.get_header()
             hdr2 = hdr.copy()
@@ -1087,31 +1469,152 @@ class CombineParcellations(BaseInterface):
 
             # Threshold roi scale 1 with unlabeled BrainStem
             if scale == 'scale1':
-                gmMask[gmMask>0] = 1
+                # Brain stem voxels are those written by the brain stem relabelling step
+                gmMask = np.zeros(It.shape, dtype=np.int16)
+                gmMask[(It > 0) & (written_by != brainstem_rank)] = 1
                 gmMask_fn = op.abspath('T1w_class-GM.nii.gz'.format(outprefixName))
                 print("Save graymatter mask to %s" % gmMask_fn)
-                img = ni.Nifti1Image(gmMask, V.get_affine(), hdr2)
-                ni.save(img, gmMask_fn)
+                img = ni.Nifti1Image(bbox.paste(gmMask), V.get_affine(), hdr2)
+                writer.save(img, gmMask_fn)
 
             # Fix negative values
             It[It<0] = 0
 
+            # Create GraphML if enabled, with the adjacency of the final regions as edges
+            if self.inputs.create_graphml:
+                graphML_file = op.abspath('{}.graphml'.format(outprefixName))
+                iflogger.info("  > Create graphML_file as {}".format(graphML_file))
+                edges = compute_label_adjacency(It) if self.inputs.graphml_edges else None
+                nodes.write_graphml(graphML_file, edges)
+
             # Saving the new parcellation
-            outprefixName = roi.split(".")[0]
-            outprefixName = outprefixName.split("/")[-1:][0]
             output_roi = op.abspath('{}_final.nii.gz'.format(outprefixName))
             iflogger.info("  > Save output image to {}".format(output_roi))
-            img = ni.Nifti1Image(It, V.get_affine(), hdr2)
-            ni.save(img, output_roi)
+            img = ni.Nifti1Image(bbox.paste(It), V.get_affine(), hdr2)
+            writer.save(img, output_roi)
+            cache.release(roi)
 
-            if self.inputs.create_colorLUT:
-                f_colorLUT.close()
+        def scale_outputs(roi):
+            outprefixName = roi.split(".")[0]
+            outprefixName = outprefixName.split("/")[-1:][0]
+            for elem in outprefixName.split("_"):
+                if "scale" in elem:
+                    scale = elem
 
+            filenames = [op.abspath('{}_final.nii.gz'.format(outprefixName))]
+            if self.inputs.create_colorLUT:
+                filenames.append(op.abspath('{}_FreeSurferColorLUT.txt'.format(outprefixName)))
             if self.inputs.create_graphml:
-                bottom_lines = ['{} \n'.format('  </graph>'),
-                             '{} \n'.format('</graphml>'),]
-                f_graphML.writelines(bottom_lines)
-                f_graphML.close()
+                filenames.append(op.abspath('{}.graphml'.format(outprefixName)))
+            if self.inputs.create_node_table:
+                filenames.append(op.abspath('{}_nodes.tsv'.format(outprefixName)))
+            if scale == 'scale1':
+                filenames.append(op.abspath('T1w_class-GM.nii.gz'))
+            return outprefixName, scale, filenames
+
+        def combine_scales(rois):
+            # Images are compressed and written in the background while the next scale is relabelled
+            with AsyncImageWriter() as writer:
+                for roi in rois:
+                    combine_single_scale(roi, writer)
+
+            if store is not None:
+                for roi in rois:
+                    name, _, filenames = scale_outputs(roi)
+                    store.store(name, manifests[roi], filenames)
+
+        rois = list(self.inputs.input_rois)
+
+        # Outputs of the previous run are reused for the scales whose inputs and options are unchanged.
+        # The sources of this module and of cmtklib.util (relabelling, node tables, GraphML writing) are
+        # digested with the input files, so that outputs of a previous version of the code are not reused
+        store = None
+        if self.inputs.skip_unchanged:
+            from cmp.multiscalebrainparcellator.info import __version__
+
+            store = OutputStore(op.join(fs_dir, 'tmp', 'lausanne2018'))
+            options = {'version': __version__,
+                       'interface': self.__class__.__name__,
+                       'create_colorLUT': bool(self.inputs.create_colorLUT),
+                       'create_graphml': bool(self.inputs.create_graphml),
+                       'graphml_edges': bool(self.inputs.graphml_edges),
+                       'create_node_table': bool(self.inputs.create_node_table),
+                       'thalamus_nuclei': thalamus_nuclei_defined,
+                       'hippocampal_subfields': [lh_subfield_defined, rh_subfield_defined],
+                       'brainstem_structures': brainstem_defined}
+            source_files = {'source_parcellation': inspect.getsourcefile(CombineParcellations),
+                            'source_util': inspect.getsourcefile(OutputStore)}
+
+            manifests = {}
+            for roi in rois:
+                name, scale, filenames = scale_outputs(roi)
+                inputs = dict(static_sources)
+                inputs.update(source_files)
+                inputs['roi'] = roi
+                inputs['roi_scale1'] = roi1_fname
+                inputs['rh_annot'] = op.join(fs_dir, 'label', 'rh.lausanne2008.%s.annot'%scale)
+                inputs['lh_annot'] = op.join(fs_dir, 'label', 'lh.lausanne2008.%s.annot'%scale)
+                manifests[roi] = store.manifest(inputs, options)
+
+            changed = []
+            for roi in rois:
+                name, _, filenames = scale_outputs(roi)
+                if store.restore(name, manifests[roi], filenames):
+                    iflogger.info("  > Inputs of {} unchanged: reuse the outputs of the previous run".format(name))
+                else:
+                    changed.append(roi)
+            rois = changed
+
+        number_of_processes = max(1, min(self.inputs.number_of_cores, len(rois)))
+
+        if number_of_processes == 1:
+            combine_scales(rois)
+        else:
+            iflogger.info("  > Process {} scales with {} processes".format(len(rois), number_of_processes))
+
+            # Compute the lookup keys of the shared volumes once and move them to memory-mapped
+            # files, so that the workers read them instead of each getting its own copy
+            remapper = LabelRemapper(static_sources, cache=cache)
+            for name in static_sources.keys():
+                remapper.histogram(name)
+            shared_dir = tempfile.mkdtemp(prefix='combine_parcellations_', dir=os.getcwd())
+            cache.share(shared_dir)
+
+            import multiprocessing as mp
+            jobs = []
+            for k in range(number_of_processes):
+                job = mp.Process(target=combine_scales, args=(rois[k::number_of_processes],))
+                jobs.append(job)
+                job.start()
+
+            # Ensure all of the processes have finished
+            for job in jobs:
+                job.join()
+
+            cache.unshare()
+            shutil.rmtree(shared_dir, ignore_errors=True)
+
+            failed = [job for job in jobs if job.exitcode != 0]
+            if len(failed) > 0:
+                raise RuntimeError('Combination of parcellations failed in {} of {} processes'.format(len(failed), len(jobs)))
+
+        V = cache.load(roi1_fname)
+        hdr2 = V.get_header().copy()
+        hdr2.set_data_dtype(np.int16)
+
+        aparcaseg_outputs = [op.abspath('aparc+aseg.Lausanne2018.native.nii.gz')]
+        if store is not None:
+            inputs = dict(static_sources)
+            inputs.update(source_files)
+            inputs['roi_scale1'] = roi1_fname
+            inputs['aparc_aseg'] = op.join(fs_dir, 'mri', 'aparc+aseg.mgz')
+            inputs['orig'] = op.join(fs_dir, 'mri', 'orig', '001.mgz')
+            aparcaseg_manifest = store.manifest(inputs, options)
+            if store.restore('aparc+aseg', aparcaseg_manifest, aparcaseg_outputs):
+                iflogger.info("  > Inputs of aparc+aseg unchanged: reuse the output of the previous run")
+                return runtime
+
+        writer = AsyncImageWriter()
 
         # Transform aparc+aseg.mgz to native space
         print("Correct Freesurfer generated aparc+aseg.mgz...")
@@ -1144,58 +1647,35 @@ class CombineParcellations(BaseInterface):
         if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
             iflogger.info("  > Correct Freesurfer generated aparc+aseg.mgz...")
 
-            Iaparcaseg_new = Iaparcaseg.astype(np.int32)
+            Iaparcaseg_new = as_labels(Iaparcaseg, max_label=49)
 
             # Thalamus (aparc+aseg labels: 10 and 49)
             if thalamus_nuclei_defined :
-
-                ind = np.where(Iaparcaseg==10)
-                mask_aparc_lh = np.zeros(Iaparcaseg.shape)
-                mask_aparc_lh[ind] = 1
-
-                ind = np.where(Iaparcaseg==49)
-                mask_aparc_rh = np.zeros(Iaparcaseg.shape)
-                mask_aparc_rh[ind] = 1
-
-                mask_thal_lh = np.zeros(Iaparcaseg.shape)
-                for lab in left_thalNuclei:
-                    ind = np.where(Ithal==lab)
-                    mask_thal_lh[ind] = 1
-
-                # Identify voxels not included by thalamic Nuclei - should set to 2 (Gm) or 0
-                tmp = mask_aparc_lh - mask_thal_lh
-                ind = np.where(tmp>0)
-                Iaparcaseg_new[ind] = 2
-
-                # Identify voxels not included by freesurfer thalamic mask
-                tmp = mask_aparc_lh - mask_thal_lh
-                ind = np.where(tmp<0)
-                Iaparcaseg_new[ind] = 10
-
-                out_tmp = op.join(fs_dir, 'tmp', 'aparc-thal.lh.native.nii.gz')
-                iflogger.info("    ... Save tmp image to {}".format(out_tmp))
-                img_tmp = ni.Nifti1Image(tmp, V.get_affine(), hdr2)
-                ni.save(img_tmp, out_tmp)
-
-                mask_thal_rh = np.zeros(Iaparcaseg.shape)
-                for lab in right_thalNuclei:
-                    ind = np.where(Ithal==lab)
-                    mask_thal_rh[ind] = 1
-
-                # Identify voxels not included by thalamic Nuclei - should set to 41 (Gm) or 0
-                tmp = mask_aparc_rh - mask_thal_rh
-                ind = np.where(tmp>0)
-                Iaparcaseg_new[ind] = 41
-
-                # Identify voxels not included by freesurfer thalamic mask
-                tmp = mask_aparc_rh - mask_thal_rh
-                ind = np.where(tmp<0)
-                Iaparcaseg_new[ind] = 49
-
-                out_tmp = op.join(fs_dir, 'tmp', 'aparc-thal.rh.native.nii.gz')
-                iflogger.info("    ... Save tmp image to {}".format(out_tmp))
-                img_tmp = ni.Nifti1Image(tmp, V.get_affine(), hdr2)
-                ni.save(img_tmp, out_tmp)
+                # Boolean masks are only built in the box containing the FreeSurfer and the nuclei thalamus masks.
+                # Crops are views, so the voxels relabelled in the box are relabelled in Iaparcaseg_new.
+                bbox = BoundingBox.from_mask(np.isin(Iaparcaseg, [10, 49]))
+                bbox = bbox.union(cache.derived((op.abspath(self.inputs.thalamus_nuclei), 'bounding_box'),
+                                                lambda: BoundingBox.from_mask(Ithal)))
+                Iaparc_box = bbox.crop(Iaparcaseg)
+                Ithal_box = bbox.crop(Ithal)
+                Inew_box = bbox.crop(Iaparcaseg_new)
+
+                for hemi, thal_label, gm_label, thalNuclei in [('lh', 10, 2, left_thalNuclei), ('rh', 49, 41, right_thalNuclei)]:
+                    mask_aparc = (Iaparc_box == thal_label)
+                    mask_thal = np.isin(Ithal_box, thalNuclei)
+
+                    # Identify voxels not included by thalamic Nuclei - should set to 2 / 41 (Gm) or 0
+                    Inew_box[mask_aparc & ~mask_thal] = gm_label
+
+                    # Identify voxels not included by freesurfer thalamic mask
+                    Inew_box[mask_thal & ~mask_aparc] = thal_label
+
+                    if self.inputs.create_debug_images:
+                        out_tmp = op.join(fs_dir, 'tmp', 'aparc-thal.{}.native.nii.gz'.format(hemi))
+                        iflogger.info("    ... Save tmp image to {}".format(out_tmp))
+                        tmp = mask_aparc.astype(np.int8) - mask_thal
+                        img_tmp = ni.Nifti1Image(bbox.paste(tmp), V.get_affine(), hdr2)
+                        writer.save(img_tmp, out_tmp)
             
             # # Hippocampal subfields (aparc+aseg labels: 17 and 53)
             # if (lh_subfield_defined and rh_subfield_defined):
@@ -1221,15 +1701,14 @@ class CombineParcellations(BaseInterface):
 
             # Brainstem (aparc+aseg labels: 16)
             if brainstem_defined:
-                ind = np.where(Iaparcaseg==16)
-                Iaparcaseg_new[ind] = 0
+                Iaparcaseg_new[Iaparcaseg == 16] = 0
                 Iaparcaseg_new[indstem] = 16
 
             # new_aparcaseg_native = op.join(fs_dir, 'tmp', 'aparc+aseg.Lausanne2018.native.nii.gz')
             new_aparcaseg_native = op.abspath('aparc+aseg.Lausanne2018.native.nii.gz')
             iflogger.info("    ... Save relabeled image to {}".format(new_aparcaseg_native))
             img = ni.Nifti1Image(Iaparcaseg_new, V.get_affine(), hdr2)
-            ni.save(img, new_aparcaseg_native)
+            writer.save(img, new_aparcaseg_native)
 
             # new_aparcaseg_fs = op.join(fs_dir, 'tmp', 'aparc+aseg.Lausanne2018.mgz')
             # aparcaseg_fs = op.join(fs_dir, 'mri', 'aparc+aseg.mgz')
@@ -1246,8 +1725,12 @@ class CombineParcellations(BaseInterface):
             aparcaseg_native = op.abspath('aparc+aseg.Lausanne2018.native.nii.gz')
             iflogger.info("    ... Save relabeled image to {}".format(aparcaseg_native))
             img = ni.Nifti1Image(Iaparcaseg, V.get_affine(), hdr2)
-            ni.save(img, aparcaseg_native)
+            writer.save(img, aparcaseg_native)
+
+        writer.close()
 
+        if store is not None:
+            store.store('aparc+aseg', aparcaseg_manifest, aparcaseg_outputs)
 
         return runtime
 
@@ -1258,6 +1741,8 @@ class CombineParcellations(BaseInterface):
         outputs['output_rois'] = self._gen_outfilenames('ROIv_HR_th','_final.nii.gz')
         outputs['colorLUT_files'] = self._gen_outfilenames('ROIv_HR_th','_FreeSurferColorLUT.txt')
         outputs['graphML_files'] = self._gen_outfilenames('ROIv_HR_th','.graphml')
+        if self.inputs.create_node_table:
+            outputs['node_table_files'] = self._gen_outfilenames('ROIv_HR_th','_nodes.tsv')
         return outputs
 
     def _gen_outfilenames(self, basename, posfix):
@@ -1266,6 +1751,319 @@ class CombineParcellations(BaseInterface):
             filepaths.append(op.abspath(basename+'_'+scale+posfix))
         return filepaths
 
+THALAMIC_NUCLEI_NAMES = ["Left-Pulvinar","Left-Anterior","Left-Medio_Dorsal","Left-Ventral_Latero_Dorsal","Left-Central_Lateral-Lateral_Posterior-Medial_Pulvinar",
+                         "Left-Ventral_Anterior","Left-Ventral_Latero_Ventral",
+                         "Right-Pulvinar","Right-Anterior","Right-Medio_Dorsal","Right-Ventral_Latero_Dorsal","Right-Central_Lateral-Lateral_Posterior-Medial_Pulvinar",
+                         "Right-Ventral_Anterior","Right-Ventral_Latero_Ventral"]
+
+def _load_probability_maps(prob_maps_file):
+    try:
+        # The gzip stream is kept open so that the maps are decompressed once, in order
+        return ni.load(prob_maps_file, keep_file_open=True)
+    except TypeError:
+        return ni.load(prob_maps_file)
+
+def _iter_probability_maps(img):
+    """ Yields the maps of the 4D image ``img`` one at a time, as float32 clipped to [0, 1] """
+    number_of_maps = img.shape[3] if len(img.shape) > 3 else 1
+    for n in range(number_of_maps):
+        prob = np.asarray(img.dataobj[..., n] if len(img.shape) > 3 else img.dataobj[...], dtype=np.float32)
+        np.clip(prob, 0, 1, out=prob)
+        yield prob
+
+def crop_image(in_file, out_file, box=None, margin=0):
+    """ Saves the (3D or 4D) image ``in_file`` cropped to a box of its voxel grid as ``out_file`` (float32).
+
+    Parameters
+    ----------
+    in_file : str
+        Image to crop
+
+    out_file : str
+        Cropped image, whose affine is translated so that it stays aligned with ``in_file``
+
+    box : BoundingBox
+        Box of the grid of ``in_file`` (if None, the box of the voxels that are non-zero in any
+        volume, padded by ``margin`` voxels)
+
+    margin : int
+        Padding of the box of non-zero voxels
+
+    Returns
+    -------
+    box : BoundingBox
+        The box of the cropped image (the full grid if the box is empty)
+    """
+    img = _load_probability_maps(in_file)
+    if box is None:
+        box = BoundingBox(img.shape, (0, 0, 0), (0, 0, 0))
+        for n in range(img.shape[3] if len(img.shape) > 3 else 1):
+            volume = np.asarray(img.dataobj[..., n] if len(img.shape) > 3 else img.dataobj[...])
+            box = box.union(BoundingBox.from_mask(volume != 0, margin=margin))
+            del volume
+    if box.is_empty():
+        box = BoundingBox.full(img.shape)
+    hdr = img.header.copy()
+    hdr.set_data_dtype(np.float32)
+    data = np.asarray(img.dataobj[box.slices], dtype=np.float32)
+    ni.save(ni.Nifti1Image(data, box.crop_affine(img.affine), hdr), out_file)
+    return box
+
+def read_probability_maps(prob_maps_file, box=None):
+    """ Reads the maps of a 4D probability image one at a time, through the array proxy of the image.
+
+    Each map is clipped to [0, 1] and only its box of non-zero voxels is kept in memory,
+    so that the full 4D image is never loaded.
+
+    If the image is cropped to the box ``box`` of a full grid (see ``crop_image``), the boxes
+    of the maps are given in the full grid.
+
+    Returns
+    -------
+    img : nibabel image
+        The (unloaded) probability image
+
+    maps : list
+        (BoundingBox, float32 map cropped to the box) for each map
+    """
+    img = _load_probability_maps(prob_maps_file)
+    maps = []
+    for prob in _iter_probability_maps(img):
+        map_box = BoundingBox.from_mask(prob > 0)
+        cropped = map_box.crop(prob).copy()
+        if box is not None:
+            map_box = BoundingBox(box.shape, box.lower + map_box.lower, box.lower + map_box.upper)
+        maps.append((map_box, cropped))
+        del prob
+    return img, maps
+
+def probability_maps_leave_box(maps, box, threshold):
+    """ Tells whether some of the maps read by ``read_probability_maps`` in the box ``box`` of a full grid
+    reach ``threshold`` on a face of the box that lies inside the grid.
+
+    Such a map is truncated by the box: it goes on outside of the box, where its maximum may lie.
+    """
+    for map_box, prob in maps:
+        if map_box.is_empty():
+            continue
+        for axis in range(3):
+            face = [slice(None)] * 3
+            if box.lower[axis] > 0 and map_box.lower[axis] == box.lower[axis]:
+                face[axis] = 0
+                if np.any(prob[tuple(face)] >= threshold):
+                    return True
+            if box.upper[axis] < box.shape[axis] and map_box.upper[axis] == box.upper[axis]:
+                face[axis] = -1
+                if np.any(prob[tuple(face)] >= threshold):
+                    return True
+    return False
+
+def update_max_probability(max_prob, max_label, prob, label):
+    """ Updates in place the running maximum probability ``max_prob`` and its label ``max_label``
+    with the map ``prob`` of ``label``.
+
+    The comparison is strict so that ties go to the first map and voxels where all maps are
+    zero keep their label, as with ``numpy.argmax`` over the stacked maps.
+    """
+    update = prob > max_prob
+    max_prob[update] = prob[update]
+    max_label[update] = label
+
+def compute_probability_map_volumes(prob_maps_file, threshold=0.05):
+    """ Computes the volumes of the probability maps stacked in a 4D image, reading one map at a time.
+
+    Maps are read through the array proxy of the image, so that only one 3D map
+    (plus the running maximum probability and its map index) is held in memory.
+
+    Parameters
+    ----------
+    prob_maps_file : str
+        4D image of probability maps (e.g. ``*_class-thalamus_probtissue.nii.gz``)
+
+    threshold : float
+        Probability below which a voxel is not assigned to the map of maximum probability
+
+    Returns
+    -------
+    prob_volumes : numpy.ndarray
+        Probabilistic volume of each map (sum of the probabilities, clipped to [0, 1], in mm3)
+
+    maxprob_volumes : numpy.ndarray
+        Volume (in mm3) of the voxels where each map has the maximum probability, as in the
+        maximum-probability label image
+    """
+    img = _load_probability_maps(prob_maps_file)
+    number_of_maps = img.shape[3] if len(img.shape) > 3 else 1
+    voxel_volume = float(np.prod(img.header.get_zooms()[:3]))
+
+    prob_volumes = np.zeros(number_of_maps)
+    best = np.zeros(img.shape[:3], dtype=np.float32)
+    best_label = np.zeros(img.shape[:3], dtype=label_dtype(number_of_maps))
+    for n, prob in enumerate(_iter_probability_maps(img)):
+        prob_volumes[n] = prob.sum(dtype=np.float64) * voxel_volume
+        prob[prob < threshold] = 0
+        update_max_probability(best, best_label, prob, n + 1)
+        del prob
+
+    maxprob_volumes = np.bincount(best_label.ravel(), minlength=number_of_maps + 1)[1:] * voxel_volume
+    return prob_volumes, maxprob_volumes
+
+def ants_environ(number_of_cores):
+    """ Returns the environment of the ANTs commands, running with ``number_of_cores`` threads """
+    env = dict(os.environ)
+    env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(number_of_cores)
+    return env
+
+def register_thalamus_template(T1w_image, template_image, number_of_cores=1, bias_correction=False, store_directory=None):
+    """ Registers the thalamus template to the T1w image with ``antsRegistrationSyNQuick.sh``
+    and computes the Jacobian determinant of the warp, in the current directory.
+
+    Parameters
+    ----------
+    T1w_image : str
+        Fixed T1w image
+
+    template_image : str
+        Moving template image
+
+    number_of_cores : int
+        Number of threads used by the ANTs commands
+
+    bias_correction : bool
+        If True, the bias field of the T1w image is corrected with ``N4BiasFieldCorrection``
+        before the registration (for a raw T1w image rather than the intensity-normalised FreeSurfer T1)
+
+    store_directory : str
+        If given, the registration is kept in this directory and reused as long as the T1w image,
+        the template and the registration parameters are unchanged (see ``OutputStore``)
+
+    Returns
+    -------
+    registration : dict
+        ``transform_file``, ``warp_file``, ``inverse_warp_file``, ``warped_image``,
+        ``inverse_warped_image`` and ``jacobian_file``
+    """
+    outprefixName = T1w_image.split(".")[0]
+    outprefixName = outprefixName.split("/")[-1:][0]
+    registration_prefix = op.abspath('{}_Ind2temp'.format(outprefixName))
+    registration = {'transform_file': op.abspath('{}_Ind2temp0GenericAffine.mat'.format(outprefixName)),
+                    'warp_file': op.abspath('{}_Ind2temp1Warp.nii.gz'.format(outprefixName)),
+                    'inverse_warp_file': op.abspath('{}_Ind2temp1InverseWarp.nii.gz'.format(outprefixName)),
+                    'warped_image': op.abspath('{}_Ind2tempWarped.nii.gz'.format(outprefixName)),
+                    'inverse_warped_image': op.abspath('{}_Ind2tempInverseWarped.nii.gz'.format(outprefixName)),
+                    'jacobian_file': op.abspath('{}_class-thalamus_probtissue_jacobian.nii.gz'.format(outprefixName))}
+    registration_files = [registration[name] for name in ['transform_file', 'warp_file', 'inverse_warp_file',
+                                                          'warped_image', 'inverse_warped_image', 'jacobian_file']]
+    ants_env = ants_environ(number_of_cores)
+
+    # The registration (and its jacobian) is reused if the T1w image, the template and
+    # the registration parameters are the same as in the previous run
+    if store_directory is not None:
+        store = OutputStore(store_directory)
+        options = {'registration': 'antsRegistrationSyNQuick.sh',
+                   'transform': 's',
+                   'bias_correction': 'N4BiasFieldCorrection' if bias_correction else None,
+                   'number_of_threads': number_of_cores}
+        manifest = store.manifest({'T1w_image': T1w_image, 'template_image': template_image}, options)
+        if store.restore('Ind2temp', manifest, registration_files):
+            iflogger.info('  > Inputs of the registration unchanged: reuse the registration of the previous run')
+
+            iflogger.info("-------------------------------------------------------")
+            return registration
+
+    fixed_image = T1w_image
+    if bias_correction:
+        # Correct the bias field of the T1w image, which is not intensity-normalised as the FreeSurfer T1
+        fixed_image = op.abspath('{}_biascorr.nii.gz'.format(outprefixName))
+        cmd = 'N4BiasFieldCorrection -d 3 -i "{}" -o "{}"'.format(T1w_image,fixed_image)
+
+        iflogger.info('  > Correct the bias field of the subject T1w image using ANTs')
+        iflogger.info('    ... Command: {}'.format(cmd))
+
+        process = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = ants_env)
+        proc_stdout = process.communicate()[0].strip()
+        iflogger.info(proc_stdout)
+
+        iflogger.info("-------------------------------------------------------")
+
+    # Register the template image image to the subject T1w image
+    # cmd = fs_string + '; antsRegistrationSyN.sh -d 3 -f "%s" -m "%s" -t s -n "%i" -o "%s"' % (T1w_image,template_image,12,registration_prefix)
+    cmd = 'antsRegistrationSyNQuick.sh -d 3 -f "{}" -m "{}" -t s -n "{}" -o "{}"'.format(fixed_image,template_image,number_of_cores,registration_prefix)
+
+    iflogger.info('  > Register the template image image to the subject T1w image using ANTs')
+    iflogger.info('    ... Command: {}'.format(cmd))
+
+    process = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = ants_env)
+    proc_stdout = process.communicate()[0].strip()
+    iflogger.info(proc_stdout)
+
+    iflogger.info("-------------------------------------------------------")
+
+    # Compute and save jacobian
+    # cmd = fs_string + '; CreateJacobianDeterminantImage 3 "%s" "%s" ' % (warp_file,jacobian_file)
+    cmd = 'CreateJacobianDeterminantImage 3 "%s" "%s" ' % (registration['warp_file'],registration['jacobian_file'])
+
+    iflogger.info('  > Compute and save jacobian')
+    iflogger.info('    ... Command: {}'.format(cmd))
+
+    process = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = ants_env)
+    proc_stdout = process.communicate()[0].strip()
+    iflogger.info(proc_stdout)
+
+    iflogger.info("-------------------------------------------------------")
+
+    if store_directory is not None and all(op.exists(filename) for filename in registration_files):
+        store.store('Ind2temp', manifest, registration_files)
+
+    return registration
+
+class RegisterThalamusTemplateInputSpec(BaseInterfaceInputSpec):
+    T1w_image = File(mandatory=True, desc='T1w image to which the template is registered')
+    template_image = File(mandatory=True, desc='Template T1w')
+    number_of_cores = traits.Int(1,usedefault=True,desc='Number of threads used by the ANTs commands (set as ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS)')
+    bias_correction = traits.Bool(True,usedefault=True,desc='Correct the bias field of the T1w image with N4BiasFieldCorrection before the registration')
+    skip_unchanged = traits.Bool(False,usedefault=True,desc='Reuse the registration of the previous run (kept in store_directory) if the T1w image, the template and the registration parameters are unchanged')
+    store_directory = Directory(desc='Directory where the registration is kept when skip_unchanged is set')
+
+class RegisterThalamusTemplateOutputSpec(TraitedSpec):
+    transform_file = File(desc='Affine transform from the T1w image to the template')
+    warp_file = File(desc='Warp from the T1w image to the template')
+    inverse_warp_file = File(desc='Inverse warp')
+    warped_image = File(desc='Template registered to T1w image (native)')
+    inverse_warped_image = File(desc='Inverse warped template')
+    jacobian_file = File(desc='Jacobian determinant of the warp')
+
+class RegisterThalamusTemplate(BaseInterface):
+    """ Registers the thalamus template to the T1w image.
+
+    The registration only needs the T1w image, so that it can run while FreeSurfer
+    processes the subject; its outputs are given to ``ParcellateThalamus``. As the raw T1w
+    image is used instead of the FreeSurfer T1, its bias field is corrected first (see ``bias_correction``).
+    """
+    input_spec = RegisterThalamusTemplateInputSpec
+    output_spec = RegisterThalamusTemplateOutputSpec
+
+    def _run_interface(self, runtime):
+        iflogger.info("-------------------------------------------------------")
+        iflogger.info("Registration of the thalamus template")
+        iflogger.info("-------------------------------------------------------")
+
+        store_directory = None
+        if self.inputs.skip_unchanged:
+            if not isdefined(self.inputs.store_directory):
+                raise ValueError('store_directory must be given when skip_unchanged is set')
+            store_directory = self.inputs.store_directory
+        self._registration = register_thalamus_template(self.inputs.T1w_image, self.inputs.template_image,
+                                                        number_of_cores=self.inputs.number_of_cores,
+                                                        bias_correction=self.inputs.bias_correction,
+                                                        store_directory=store_directory)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update(self._registration)
+        return outputs
+
 class ParcellateThalamusInputSpec(BaseInterfaceInputSpec):
     T1w_image = File(mandatory=True, desc='T1w image to be parcellated')
     bids_dir = Directory(desc='BIDS root directory')
@@ -1273,6 +2071,12 @@ class ParcellateThalamusInputSpec(BaseInterfaceInputSpec):
     session = traits.Str('',desc='Session id')
     template_image = File(mandatory=True, desc='Template T1w')
     thalamic_nuclei_maps = File(mandatory=True, desc='Probability maps of thalamic nuclei (4D image) in template space')
+    number_of_cores = traits.Int(1,usedefault=True,desc='Number of threads used by the ANTs commands (set as ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS)')
+    skip_unchanged = traits.Bool(False,desc='Reuse the registration of the previous run (kept in <subject>/tmp/thalamus_registration) if the T1w image, the template and the registration parameters are unchanged')
+    transform_file = File(exists=True, desc='Affine transform of a registration computed beforehand (see RegisterThalamusTemplate)')
+    warp_file = File(exists=True, desc='Warp of a registration computed beforehand (see RegisterThalamusTemplate)')
+    jacobian_file = File(exists=True, desc='Jacobian determinant of the warp of a registration computed beforehand (see RegisterThalamusTemplate)')
+    thalamus_margin = traits.Int(10, usedefault=True, desc='Margin (in voxels) around the thalamus of aparc+aseg within which the probability maps are propagated')
     subjects_dir = Directory(mandatory=True, desc='Freesurfer main directory')
     subject_id = traits.String(mandatory=True, desc='Subject ID')
 
@@ -1284,6 +2088,7 @@ class ParcellateThalamusOutputSpec(TraitedSpec):
     transform_file = File(desc='Transform file')
     warp_file = File(desc='Deformation file')
     thalamus_mask = File(desc='Thalamus mask')
+    prob_maps_stats = File(desc='Probabilistic and maximum-probability volumes of the thalamus nuclei (TSV)')
 
 class ParcellateThalamus(BaseInterface):
     input_spec = ParcellateThalamusInputSpec
@@ -1328,125 +2133,126 @@ class ParcellateThalamus(BaseInterface):
 
         outprefixName = self.inputs.T1w_image.split(".")[0]
         outprefixName = outprefixName.split("/")[-1:][0]
-        outprefixName = op.abspath('{}_Ind2temp'.format(outprefixName))
+        output_maps = op.abspath('{}_class-thalamus_probtissue.nii.gz'.format(outprefixName))
 
-        # Register the template image image to the subject T1w image
-        # cmd = fs_string + '; antsRegistrationSyN.sh -d 3 -f "%s" -m "%s" -t s -n "%i" -o "%s"' % (self.inputs.T1w_image,self.inputs.template_image,12,outprefixName)
-        cmd = 'antsRegistrationSyNQuick.sh -d 3 -f "{}" -m "{}" -t s -n "{}" -o "{}"'.format(self.inputs.T1w_image,self.inputs.template_image,12,outprefixName)
+        # ANTs commands run with the number of threads given to the node
+        ants_env = ants_environ(self.inputs.number_of_cores)
 
-        iflogger.info('  > Register the template image image to the subject T1w image using ANTs')
-        iflogger.info('    ... Command: {}'.format(cmd))
+        if isdefined(self.inputs.transform_file) and isdefined(self.inputs.warp_file) and isdefined(self.inputs.jacobian_file):
+            # Registration computed by a RegisterThalamusTemplate node
+            transform_file = self.inputs.transform_file
+            warp_file = self.inputs.warp_file
+            jacobian_file = self.inputs.jacobian_file
+        else:
+            store_directory = None
+            if self.inputs.skip_unchanged:
+                store_directory = op.join(self.inputs.subjects_dir,self.inputs.subject_id,'tmp','thalamus_registration')
+            registration = register_thalamus_template(self.inputs.T1w_image, self.inputs.template_image,
+                                                      number_of_cores=self.inputs.number_of_cores, store_directory=store_directory)
+            transform_file = registration['transform_file']
+            warp_file = registration['warp_file']
+            jacobian_file = registration['jacobian_file']
+
+        # Only the thalamic region is interpolated: the template maps are cropped to the box of their
+        # non-zero voxels (padded so that the BSpline coefficients near the maps are unchanged) and
+        # the reference grid to the box of the thalamus of aparc+aseg, padded by thalamus_margin voxels
+        cropped_nuclei_maps = op.abspath('{}_class-thalamus_template_probtissue_cropped.nii.gz'.format(outprefixName))
+        iflogger.info('  > Crop template probability maps to {}'.format(cropped_nuclei_maps))
+        crop_image(self.inputs.thalamic_nuclei_maps, cropped_nuclei_maps, margin=8)
+
+        cropped_reference = op.abspath('{}_class-thalamus_reference_cropped.nii.gz'.format(outprefixName))
+        reference_box = BoundingBox.from_mask((Ia == 10) | (Ia == 49), margin=self.inputs.thalamus_margin)
+        # The maps, the Jacobian and aparc+aseg are combined voxel by voxel: they are all resampled
+        # on the grid of aparc+aseg in native space, which the T1w image is expected to share
+        reference_image = self.inputs.T1w_image
+        reference_img = ni.load(reference_image)
+        if reference_img.shape[:3] != Ia.shape[:3] or not np.allclose(reference_img.affine, Vatlas.affine):
+            iflogger.warning('  > {} is not in the voxel grid of {}: the maps are propagated to the full grid of {}'.format(reference_image, Vatlas_fn, Vatlas_fn))
+            reference_image = Vatlas_fn
+            reference_box = BoundingBox.full(Ia.shape)
+        elif reference_box.is_empty():
+            reference_box = BoundingBox.full(Ia.shape)
+        del reference_img
+
+        cropped_output_maps = op.abspath('{}_class-thalamus_probtissue_cropped.nii.gz'.format(outprefixName))
 
-        process = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-        proc_stdout = process.communicate()[0].strip()
-        iflogger.info(proc_stdout)
+        Thresh = 0.05
 
-        iflogger.info("-------------------------------------------------------")
+        while True:
+            iflogger.info('  > Crop reference image to {}'.format(cropped_reference))
+            crop_image(reference_image, cropped_reference, box=reference_box)
 
-        outprefixName = self.inputs.T1w_image.split(".")[0]
-        outprefixName = outprefixName.split("/")[-1:][0]
-        transform_file = op.abspath('{}_Ind2temp0GenericAffine.mat'.format(outprefixName))
-        warp_file = op.abspath('{}_Ind2temp1Warp.nii.gz'.format(outprefixName))
-        #transform_file = '/home/localadmin/~/Desktop/parcellation_tests/sub-A006_ses-20160520161029_T1w_brain_Ind2temp0GenericAffine.mat'
-        #warp_file = '/home/localadmin/~/Desktop/parcellation_tests/sub-A006_ses-20160520161029_T1w_brain_Ind2temp1Warp.nii.gz'
-        output_maps = op.abspath('{}_class-thalamus_probtissue.nii.gz'.format(outprefixName))
-        jacobian_file = op.abspath('{}_class-thalamus_probtissue_jacobian.nii.gz'.format(outprefixName))
+            # Propagate nuclei probability maps to subject T1w space using estimated transforms and deformation
+            # cmd = fs_string + '; antsApplyTransforms --float -d 3 -e 3 -i "%s" -o "%s" -r "%s" -t "%s" -t "%s" -n BSpline[3]' % (self.inputs.thalamic_nuclei_maps,output_maps,self.inputs.T1w_image,warp_file,transform_file)
+            cmd = 'antsApplyTransforms --float -d 3 -e 3 -i "%s" -o "%s" -r "%s" -t "%s" -t "%s" -n BSpline[3]' % (cropped_nuclei_maps,cropped_output_maps,cropped_reference,warp_file,transform_file)
 
-        # Compute and save jacobian
-        # cmd = fs_string + '; CreateJacobianDeterminantImage 3 "%s" "%s" ' % (warp_file,jacobian_file)
-        cmd = 'CreateJacobianDeterminantImage 3 "%s" "%s" ' % (warp_file,jacobian_file)
+            iflogger.info('  > Propagate nuclei probability maps to subject T1w space using estimated transforms and deformation')
+            iflogger.info('    ... Command: {}'.format(cmd))
 
-        iflogger.info('  > Compute and save jacobian')
-        iflogger.info('    ... Command: {}'.format(cmd))
+            process = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = ants_env)
+            proc_stdout = process.communicate()[0].strip()
+            iflogger.info(proc_stdout)
 
-        process = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-        proc_stdout = process.communicate()[0].strip()
-        iflogger.info(proc_stdout)
+            # Load probability maps in native space after applying estimated transform and deformation.
+            # Maps are read one nucleus at a time, clipped to [0, 1] and kept in the box of their non-zero voxels
+            # (located in the full grid)
+            imgVspams, Vspams = read_probability_maps(cropped_output_maps, box=reference_box)
+
+            # The maps are normalised by their maximum after the Jacobian correction: a map still above
+            # the threshold on a face of the box may peak outside of it, so it is propagated again to the full grid
+            if not probability_maps_leave_box(Vspams, reference_box, Thresh):
+                break
+            iflogger.warning('  > Propagated nuclei probability maps leave the box of the thalamus padded by {} voxels: they are propagated to the full grid'.format(self.inputs.thalamus_margin))
+            del imgVspams, Vspams
+            reference_box = BoundingBox.full(reference_box.shape)
 
         iflogger.info("-------------------------------------------------------")
 
-        # Propagate nuclei probability maps to subject T1w space using estimated transforms and deformation
-        # cmd = fs_string + '; antsApplyTransforms --float -d 3 -e 3 -i "%s" -o "%s" -r "%s" -t "%s" -t "%s" -n BSpline[3]' % (self.inputs.thalamic_nuclei_maps,output_maps,self.inputs.T1w_image,warp_file,transform_file)
-        cmd = 'antsApplyTransforms --float -d 3 -e 3 -i "%s" -o "%s" -r "%s" -t "%s" -t "%s" -n BSpline[3]' % (self.inputs.thalamic_nuclei_maps,output_maps,self.inputs.T1w_image,warp_file,transform_file)
+        iflogger.info('  > Correcting the volumes after the interpolation ')
+        # Images are compressed and written in the background while the next ones are computed
+        writer = AsyncImageWriter()
+
+        # The Jacobian is in the grid of the fixed image of the registration: it is resampled on the
+        # cropped reference grid of the maps
+        cropped_jacobian = op.abspath('{}_class-thalamus_jacobian_cropped.nii.gz'.format(outprefixName))
+        cmd = 'antsApplyTransforms --float -d 3 -i "%s" -o "%s" -r "%s" -t identity -n Linear' % (jacobian_file,cropped_jacobian,cropped_reference)
 
-        iflogger.info('  > Propagate nuclei probability maps to subject T1w space using estimated transforms and deformation')
+        iflogger.info('  > Resample jacobian to the reference grid')
         iflogger.info('    ... Command: {}'.format(cmd))
 
-        process = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        process = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = ants_env)
         proc_stdout = process.communicate()[0].strip()
         iflogger.info(proc_stdout)
 
-        iflogger.info("-------------------------------------------------------")
-
-        iflogger.info('  > Correcting the volumes after the interpolation ')
         # Load jacobian file
-        Ij = ni.load(jacobian_file).get_data()	# numpy.ndarray
-
-        # Load probability maps in native space after applying estimated transform and deformation
-        imgVspams = ni.load(output_maps)
-        Vspams = imgVspams.get_data()	# numpy.ndarray
-        Vspams[Vspams < 0] = 0
-        Vspams[Vspams > 1] = 1
-
-        Thresh = 0.05
-        # Creating MaxProb
-        Ispams = Vspams.copy()
-        ind = np.where(Ispams < Thresh)
-        Ispams[ind] = 0
-        ind = np.where(np.sum(Ispams,axis=3) == 0)
-        MaxProb = Ispams.argmax(axis=3) + 1
-        MaxProb[ind] = 0;
-        #?MaxProb = imfill(MaxProb,'holes');
-
-        del Ispams
-
-        debug_file = op.abspath('{}_class-thalamus_dtissue_after_ants.nii.gz'.format(outprefixName))
-        iflogger.info("    ... Save uncorrected MaxProb image to {}".format(debug_file))
-        img = ni.Nifti1Image(MaxProb, Vatlas.get_affine(), hdr2)
-        ni.save(img, debug_file)
-
-        # Take into account jacobian to correct the probability maps after interpolation
-        Ispams = np.zeros(Vspams.shape)
-        for nuc in np.arange(Vspams.shape[3]):
-            tempImage = Vspams[:,:,:,nuc]
-            T = np.multiply(tempImage,Ij)
-            Ispams[:,:,:,nuc] = T / T.max()
-        del tempImage, T, Vspams, Ij
-
-        # Creating MaxProb
-        ind = np.where(Ispams < Thresh)
-        Ispams[ind] = 0
-        ind = np.where(np.sum(Ispams,axis=3) == 0)
-        MaxProb = Ispams.argmax(axis=3) + 1
-        MaxProb[ind] = 0;
-        #?MaxProb = imfill(MaxProb,'holes');
-
-        debug_file = op.abspath('{}_class-thalamus_dtissue_after_jacobiancorr.nii.gz'.format(outprefixName))
-        iflogger.info("    ... Save Jacobian-corrected MaxProb image to {}".format(debug_file))
-        img = ni.Nifti1Image(MaxProb, Vatlas.get_affine(), hdr2)
-        ni.save(img, debug_file)
+        imgIj = ni.load(cropped_jacobian)
+        for img in [imgIj, imgVspams]:
+            if img.shape[:3] != reference_box.cropped_shape or not np.allclose(img.affine, reference_box.crop_affine(Vatlas.affine)):
+                raise ValueError('{} is not in the voxel grid of {} cropped to the thalamus'.format(img.get_filename(), Vatlas_fn))
+        Ij = np.asarray(imgIj.get_data(), dtype=np.float32)
+        del imgIj
+
+        Nspams = len(Vspams)
+
+        # Everything below is computed in the box containing the propagated probability maps and
+        # the thalamus of aparc+aseg, and pasted back to the full grid when saved
+        bbox = BoundingBox.from_mask((Ia == 10) | (Ia == 49))
+        for spam_box, _ in Vspams:
+            bbox = bbox.union(spam_box)
+        if bbox.is_empty():
+            bbox = BoundingBox.full(Ia.shape)
+        Ij = bbox.relative_to(reference_box).crop(Ij)
+        Ia = bbox.crop(Ia)
 
         iflogger.info('  > Creating Thalamus mask from FreeSurfer aparc+aseg ')
 
         fs_string = 'export SUBJECTS_DIR=' + self.inputs.subjects_dir
         iflogger.info('    ... FreeSurfer SUBJECTS_DIR:\n  {}\n'.format(self.inputs.subjects_dir))
 
-        #Extract indices of left/right thalamus mask from aparc+aseg volume
-        indl = np.where(Ia == 10)
-        indr = np.where(Ia == 49)
-
-        def filter_isolated_cells(array, struct):
-            """ Return array with completely isolated single cells removed
-            :param array: Array with completely isolated single cells
-            :param struct: Structure array for generating unique regions
-            :return: Array with minimum region size > 1
-            """
-            filtered_array = np.copy(array)
-            id_regions, num_ids = ndimage.label(filtered_array, structure=struct)
-            id_sizes = np.array(ndimage.sum(array, id_regions, range(num_ids + 1)))
-            area_mask = (id_sizes == 1)
-            filtered_array[area_mask[id_regions]] = 0
-            return filtered_array
+        # Creating Thalamic Mask (1: Left, 2:Right)
+        Ithal = np.zeros(Ia.shape, dtype=label_dtype(2))
+        Ithal[Ia == 10] = 1
+        Ithal[Ia == 49] = 2
 
         remove_isolated_points = True
         if remove_isolated_points:
@@ -1455,28 +2261,10 @@ class ParcellateThalamus(BaseInterface):
             #struct = np.zeros((3,3,3))
             #struct[1,1,1] = 1
 
-            # Left Hemisphere
-            # Removing isolated points
-            tempI = np.zeros(Ia.shape)
-            tempI[indl] = 1;
-            tempI = filter_isolated_cells(tempI,struct=struct)
-            indl = np.where(tempI == 1);
-
-            # Right Hemisphere
-            # Removing isolated points
-            tempI = np.zeros(Ia.shape)
-            tempI[indr] = 1;
-            tempI = filter_isolated_cells(tempI,struct=struct)
-            indr = np.where(tempI == 1)
+            # Removing isolated points of both hemispheres
+            Ithal = remove_small_components(Ithal, min_size=2, structure=struct)
 
-            del struct, tempI
-
-        # Creating Thalamic Mask (1: Left, 2:Right)
-        Ithal = np.zeros(Ia.shape)
-        Ithal[indl]  = 1
-        Ithal[indr] = 2
-
-        del indl, indr
+            del struct
 
         #TODO: Masking according to csf
         # unzip_nifti([freesDir filesep subjId filesep 'tmp' filesep 'T1native.nii.gz']);
@@ -1494,70 +2282,72 @@ class ParcellateThalamus(BaseInterface):
         hdr2 = hdr.copy()
         hdr2.set_data_dtype(np.uint16)
         iflogger.info("    ... Save thalamic nuclei image to %s" % thalamus_mask)
-        Vthal = ni.Nifti1Image(Ithal, Vatlas.get_affine(), hdr2)
-        ni.save(Vthal, thalamus_mask)
-
-        del hdr, hdr2, Vthal
-
+        Vthal = ni.Nifti1Image(bbox.paste(Ithal), Vatlas.get_affine(), hdr2)
+        writer.save(Vthal, thalamus_mask)
 
-        Nspams = Ispams.shape[3]
-        Thresh = 0.05
+        del hdr, Vthal
 
         use_thalamus_mask = True
+
+        # The nuclei are corrected one at a time in float32: MaxProb images are built from the running
+        # maximum probability of the nuclei (before and after the Jacobian correction), and only the
+        # corrected maps are kept in 4D
+        maxprob_shape = bbox.cropped_shape
+        MaxProbAnts = np.zeros(maxprob_shape, dtype=label_dtype(Nspams))
+        MaxProbJac = np.zeros(maxprob_shape, dtype=label_dtype(Nspams))
+        bestAnts = np.zeros(maxprob_shape, dtype=np.float32)
+        bestJac = np.zeros(maxprob_shape, dtype=np.float32)
+        Ispams = np.zeros(maxprob_shape + (Nspams,), dtype=np.float32)
+
+        # Masked maps are non-zero only in the thalamus: the final MaxProb is computed on the
+        # (thalamus voxels x nuclei) block of the masked maps and scattered back
         if use_thalamus_mask:
-            IthalL = np.zeros(Ithal.shape)
-            indl = np.where(Ithal == 1)
-            IthalL[indl] = 1
-            del indl
+            thal_voxels = np.flatnonzero(Ithal)
+            IspamsThal = np.zeros((thal_voxels.size, Nspams), dtype=np.float32)
 
-            IthalR = np.zeros(Ithal.shape)
-            indr = np.where(Ithal == 2)
-            IthalR[indr] = 1
+        for nuc in np.arange(Nspams):
+            spam_box, spam = Vspams[nuc]
+            tempImage = np.zeros(maxprob_shape, dtype=np.float32)
+            tempImage[spam_box.relative_to(bbox).slices] = spam
+            Vspams[nuc] = None
+            del spam
 
-            del Ithal
+            # Creating MaxProb
+            T = tempImage.copy()
+            T[T < Thresh] = 0
+            update_max_probability(bestAnts, MaxProbAnts, T, nuc + 1)
 
-            # Mask probability maps using the left-hemisphere thalamus mask
-            tmpIthalL = np.zeros((IthalL.shape[0],IthalL.shape[1],IthalL.shape[2],1))
-            tmpIthalL[:,:,:,0] = IthalL
-            tempM = np.repeat(tmpIthalL,Nspams/2,axis=3)
-            del tmpIthalL
-            IspamL = np.multiply(Ispams[:,:,:,0:Nspams/2],tempM)
-            del tempM
+            # Take into account jacobian to correct the probability maps after interpolation
+            np.multiply(tempImage, Ij, out=T)
+            T /= T.max()
+            del tempImage
 
             # Creating MaxProb
-            ind = np.where(IspamL < Thresh)
-            IspamL[ind] = 0
-            ind = np.where(np.sum(IspamL,axis=3) == 0)
-            #MaxProbL = IspamL.max(axis=3)
-            MaxProbL = np.argmax(IspamL,axis=3) + 1
-            MaxProbL[ind] = 0
-            #MaxProbL[ind] = 0
-            #?MaxProbL = ndimage.binary_fill_holes(MaxProbL)
-            #?MaxProbL = Atlas_Corr(IthalL,MaxProbL)
-
-            # Mask probability maps using the right-hemisphere thalamus mask
-            tmpIthalR = np.zeros((IthalR.shape[0],IthalR.shape[1],IthalR.shape[2],1))
-            tmpIthalR[:,:,:,0] = IthalR
-            tempM = np.repeat(tmpIthalR,Nspams/2,axis=3)
-            del tmpIthalR
-            IspamR = np.multiply(Ispams[:,:,:,Nspams/2:Nspams],tempM)
-            del tempM
+            T[T < Thresh] = 0
+            update_max_probability(bestJac, MaxProbJac, T, nuc + 1)
 
-            # Creating MaxProb
-            ind = np.where(IspamR < Thresh)
-            IspamR[ind] = 0
-            ind = np.where(np.sum(IspamR,axis=3) == 0)
-            #MaxProbR = IspamR.max(axis=3)
-            MaxProbR = np.argmax(IspamR,axis=3) + 1
-            #?MaxProbR = imfill(MaxProbR,'holes');
-            #?MaxProbR = Atlas_Corr(IthalR,MaxProbR);
-            MaxProbR[indr] = MaxProbR[indr] + Nspams/2;
-            MaxProbR[ind] = 0
+            # Mask probability maps using the thalamus mask of the hemisphere of the nucleus
+            if use_thalamus_mask:
+                T *= (Ithal == (1 if nuc < Nspams / 2 else 2))
+                IspamsThal[:,nuc] = T.ravel()[thal_voxels]
 
-            del indr
+            Ispams[:,:,:,nuc] = T
+            del T
 
-            Ispams[:,:,:,0:Nspams/2] = IspamL
-            Ispams[:,:,:,Nspams/2:Nspams] = IspamR
+        del Vspams, Ij, Ithal, bestAnts, bestJac
+        #?MaxProb = imfill(MaxProb,'holes');
+
+        debug_file = op.abspath('{}_class-thalamus_dtissue_after_ants.nii.gz'.format(outprefixName))
+        iflogger.info("    ... Save uncorrected MaxProb image to {}".format(debug_file))
+        img = ni.Nifti1Image(bbox.paste(MaxProbAnts), Vatlas.get_affine(), hdr2)
+        writer.save(img, debug_file)
+
+        debug_file = op.abspath('{}_class-thalamus_dtissue_after_jacobiancorr.nii.gz'.format(outprefixName))
+        iflogger.info("    ... Save Jacobian-corrected MaxProb image to {}".format(debug_file))
+        img = ni.Nifti1Image(bbox.paste(MaxProbJac), Vatlas.get_affine(), hdr2)
+        writer.save(img, debug_file)
+
+        del MaxProbAnts
 
         # Save corrected probability maps of thalamic nuclei
         # update the header
@@ -1565,10 +2355,10 @@ class ParcellateThalamus(BaseInterface):
         hdr2 = hdr.copy()
         hdr2.set_data_dtype(np.uint16)
         iflogger.info("    ... Save corrected probability maps of thalamic nuclei to {}".format(output_maps))
-        img = ni.Nifti1Image(Ispams, imgVspams.get_affine(), hdr2)
-        ni.save(img, output_maps)
+        img = ni.Nifti1Image(bbox.paste(Ispams), reference_box.paste_affine(imgVspams.get_affine()), hdr2)
+        writer.save(img, output_maps)
 
-        del hdr, img, imgVspams
+        del hdr, img, imgVspams, Ispams
 
         # Save Maxprob
         # update the header
@@ -1578,17 +2368,16 @@ class ParcellateThalamus(BaseInterface):
         hdr2.set_data_dtype(np.uint16)
 
         if use_thalamus_mask:
-            MaxProb = MaxProbL + MaxProbR
-        else:
             # Creating MaxProb
-            ind = np.where(Ispams < Thresh)
-            Ispams[ind] = 0
-            ind = np.where(np.sum(Ispams,axis=3) == 0)
-            MaxProb = Ispams.argmax(axis=3) + 1
-            MaxProb[ind] = 0;
-            #?MaxProb = imfill(MaxProb,'holes');
+            MaxProbThal = IspamsThal.argmax(axis=1) + 1
+            MaxProbThal[np.sum(IspamsThal,axis=1) == 0] = 0
+            MaxProb = np.zeros(maxprob_shape, dtype=label_dtype(Nspams))
+            MaxProb.flat[thal_voxels] = MaxProbThal
+            del IspamsThal, MaxProbThal, thal_voxels
+        else:
+            MaxProb = MaxProbJac
 
-        del Ispams
+        del MaxProbJac
 
         # debug_file = '/home/localadmin/~/Desktop/parcellation_tests/sub-A006_ses-20160520161029_T1w_brain_class-thalamus_maxprobL.nii.gz'
         # iflogger.info("Save output image to %s" % debug_file)
@@ -1601,11 +2390,24 @@ class ParcellateThalamus(BaseInterface):
         # ni.save(img, debug_file)
 
         iflogger.info("    ... Save final MaxProb image to %s" % max_prob)
-        img = ni.Nifti1Image(MaxProb, Vatlas.get_affine(), hdr2)
-        ni.save(img, max_prob)
+        img = ni.Nifti1Image(bbox.paste(MaxProb), Vatlas.get_affine(), hdr2)
+        writer.save(img, max_prob)
 
         del hdr2, img, max_prob
 
+        writer.close()
+
+        # Volumes of the nuclei computed from the saved probability maps, one nucleus at a time
+        prob_maps_stats = op.abspath('{}_class-thalamus_probtissue_stats.tsv'.format(outprefixName))
+        iflogger.info("    ... Save volumes of thalamic nuclei to {}".format(prob_maps_stats))
+        prob_volumes, maxprob_volumes = compute_probability_map_volumes(output_maps, Thresh)
+        lines = ['\t'.join(["index", "name", "prob-volume-mm3", "maxprob-volume-mm3"]) + '\n']
+        for nuc in range(prob_volumes.size):
+            name = THALAMIC_NUCLEI_NAMES[nuc] if prob_volumes.size == len(THALAMIC_NUCLEI_NAMES) else 'nucleus-{}'.format(nuc + 1)
+            lines.append('\t'.join([str(nuc + 1), name, '{:.4f}'.format(prob_volumes[nuc]), '{:.4f}'.format(maxprob_volumes[nuc])]) + '\n')
+        with open(prob_maps_stats, 'w') as f:
+            f.write(''.join(lines))
+
         iflogger.info("  [Done]")
 
         return runtime
@@ -1618,13 +2420,18 @@ class ParcellateThalamus(BaseInterface):
         outputs['prob_maps_registered'] =op.abspath('{}_class-thalamus_probtissue.nii.gz'.format(outprefixName))
         outputs['max_prob_registered'] = op.abspath('{}_class-thalamus_probtissue_maxprob.nii.gz'.format(outprefixName))
         outputs['thalamus_mask'] = op.abspath('{}_class-thalamus_dtissue.nii.gz'.format(outprefixName))
+        outputs['prob_maps_stats'] = op.abspath('{}_class-thalamus_probtissue_stats.tsv'.format(outprefixName))
 
-        outprefixName = op.abspath('{}_Ind2temp'.format(outprefixName))
+        if isdefined(self.inputs.transform_file) and isdefined(self.inputs.warp_file) and isdefined(self.inputs.jacobian_file):
+            outputs['transform_file'] = self.inputs.transform_file
+            outputs['warp_file'] = self.inputs.warp_file
+        else:
+            outprefixName = op.abspath('{}_Ind2temp'.format(outprefixName))
 
-        outputs['warped_image'] = op.abspath('{}Warped.nii.gz'.format(outprefixName))
-        outputs['inverse_warped_image'] = op.abspath('{}InverseWarped.nii.gz'.format(outprefixName))
-        outputs['transform_file'] = op.abspath('{}0GenericAffine.mat'.format(outprefixName))
-        outputs['warp_file'] = op.abspath('{}1Warp.nii.gz'.format(outprefixName))
+            outputs['warped_image'] = op.abspath('{}Warped.nii.gz'.format(outprefixName))
+            outputs['inverse_warped_image'] = op.abspath('{}InverseWarped.nii.gz'.format(outprefixName))
+            outputs['transform_file'] = op.abspath('{}0GenericAffine.mat'.format(outprefixName))
+            outputs['warp_file'] = op.abspath('{}1Warp.nii.gz'.format(outprefixName))
 
         #outputs['lh_hipposubfields'] = op.join(self.inputs.subjects_dir,self.inputs.subject_id,'tmp','lh_subFields.nii.gz')
         #outputs['rh_hipposubfields'] = op.join(self.inputs.subjects_dir,self.inputs.subject_id,'tmp','rh_subFields.nii.gz')
@@ -2049,7 +2856,7 @@ def create_roi(subject_id, subjects_dir):
 
         iflogger.info("Working on parcellation: " + parkey)
         iflogger.info("========================")
-        pg = nx.read_graphml(parval['node_information_graphml'])
+        pg = read_graphml_nodes(parval['node_information_graphml'])
 
         # each node represents a brain region
         # create a big 256^3 volume for storage of all ROIs
@@ -2527,6 +3334,19 @@ def create_roi_v2(subject_id, subjects_dir,v=1):
 
     iflogger.info("[ DONE ]")
 
+_brain_bounding_boxes = {}
+
+def get_brain_bounding_box(fs_dir):
+    """ Returns the bounding box of the brain (non-zero voxels of ``mri/aseg.nii.gz``)
+    in the FreeSurfer conformed space. It is computed once per aseg file and shared
+    by the mask functions working in this space.
+    """
+    aseg_file = op.join(fs_dir, 'mri', 'aseg.nii.gz')
+    key = (aseg_file, os.stat(aseg_file).st_mtime)
+    if key not in _brain_bounding_boxes:
+        _brain_bounding_boxes[key] = BoundingBox.from_mask(ni.load(aseg_file).get_data())
+    return _brain_bounding_boxes[key]
+
 def create_wm_mask(subject_id, subjects_dir):
     iflogger.info("Create white matter mask")
 
@@ -2536,7 +3356,7 @@ def create_wm_mask(subject_id, subjects_dir):
     fsmask = ni.load(op.join(fs_dir, 'mri', 'ribbon.nii.gz'))
     fsmaskd = fsmask.get_data()
 
-    wmmask = np.zeros( fsmask.get_data().shape )
+    wmmask = empty_mask( fsmask.get_data().shape )
 
     # these data is stored and could be extracted from fs_dir/stats/aseg.txt
 
@@ -2560,8 +3380,8 @@ def create_wm_mask(subject_id, subjects_dir):
     imerode = nd.binary_erosion
 
     # ventricle erosion
-    csfA = np.zeros( asegd.shape )
-    csfB = np.zeros( asegd.shape )
+    csfA = empty_mask( asegd.shape )
+    csfB = empty_mask( asegd.shape )
 
     # structuring elements for erosion
     se1 = np.zeros( (3,3,5) )
@@ -2613,13 +3433,13 @@ def create_wm_mask(subject_id, subjects_dir):
     # would stop the fiber going to the segmented "brainstem"
 
     # grey nuclei, either with or without erosion
-    gr_ncl = np.zeros( asegd.shape )
+    gr_ncl = empty_mask( asegd.shape )
 
     # with erosion
     for i in [10,11,12,49,50,51]:
         idx = np.where(asegd == i)
         # temporary volume
-        tmp = np.zeros( asegd.shape )
+        tmp = empty_mask( asegd.shape )
         tmp[idx] = 1
         tmp = imerode(tmp,se)
         idx = np.where(tmp == 1)
@@ -2631,7 +3451,7 @@ def create_wm_mask(subject_id, subjects_dir):
         gr_ncl[idx] = 1
 
     # remove remaining structure, e.g. brainstem
-    remaining = np.zeros( asegd.shape )
+    remaining = empty_mask( asegd.shape )
     idx = np.where( asegd == 16 )
     remaining[idx] = 1
 
@@ -2671,7 +3491,7 @@ def create_wm_mask(subject_id, subjects_dir):
 
         assert roid.shape[0] == wmmask.shape[0]
 
-        pg = nx.read_graphml(parval['node_information_graphml'])
+        pg = read_graphml_nodes(parval['node_information_graphml'])
 
         for brk, brv in pg.nodes(data=True):
 
@@ -2709,7 +3529,11 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
     fsmask = ni.load(op.join(fs_dir, 'mri', 'ribbon.nii.gz'))
     fsmaskd = fsmask.get_data()
 
-    wmmask = np.zeros( fsmask.get_data().shape )
+    # All the mask arithmetic is done in the bounding box of the brain and pasted back to the full grid at save time
+    bbox = get_brain_bounding_box(fs_dir).union(BoundingBox.from_mask(fsmaskd))
+    fsmaskd = bbox.crop(fsmaskd)
+
+    wmmask = empty_mask( fsmaskd.shape )
 
     # these data is stored and could be extracted from fs_dir/stats/aseg.txt
 
@@ -2734,7 +3558,7 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
     if v:
         iflogger.info("     > Load aseg")
     aseg = ni.load(op.join(fs_dir, 'mri', 'aseg.nii.gz'))
-    asegd = aseg.get_data()
+    asegd = bbox.crop(aseg.get_data())
 
     try:
         import scipy.ndimage.morphology as nd
@@ -2746,8 +3570,8 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
 
     # ventricle erosion
     iflogger.info("    > Ventricle erosion")
-    csfA = np.zeros( asegd.shape )
-    csfB = np.zeros( asegd.shape )
+    csfA = empty_mask( asegd.shape )
+    csfB = empty_mask( asegd.shape )
 
     # structuring elements for erosion
     se1 = np.zeros( (3,3,5) )
@@ -2769,7 +3593,7 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
 
     if v:
         iflogger.info("    > Save CSF mask")
-    img = ni.Nifti1Image(csfA, aseg.get_affine(), aseg.get_header())
+    img = ni.Nifti1Image(bbox.paste(csfA), aseg.get_affine(), aseg.get_header())
     ni.save(img, op.join(fs_dir, 'mri', 'csf_mask.nii.gz'))
     csfA = imerode(imerode(csfA, se1),se)
 
@@ -2804,13 +3628,13 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
     # grey nuclei, either with or without erosion
     if v:
         iflogger.info("    > Grey nuclei, either with or without erosion")
-    gr_ncl = np.zeros( asegd.shape )
+    gr_ncl = empty_mask( asegd.shape )
 
     # with erosion
     for i in [10,11,12,49,50,51]:
         idx = np.where(asegd == i)
         # temporary volume
-        tmp = np.zeros( asegd.shape )
+        tmp = empty_mask( asegd.shape )
         tmp[idx] = 1
         tmp = imerode(tmp,se)
         idx = np.where(tmp == 1)
@@ -2824,7 +3648,7 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
     # remove remaining structure, e.g. brainstem
     if v:
         iflogger.info("    > Remove remaining structure, e.g. brainstem")
-    remaining = np.zeros( asegd.shape )
+    remaining = empty_mask( asegd.shape )
     idx = np.where( asegd == 16 )
     remaining[idx] = 1
 
@@ -2858,7 +3682,7 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
 
     # Extract cortical gray matter mask
     # remove remaining structure, e.g. brainstem
-    gmmask = np.zeros( asegd.shape )
+    gmmask = empty_mask( asegd.shape )
 
     # XXX: subtracting wmmask from ROI. necessary?
     # for parkey, parval in get_parcellation('Lausanne2018').items():
@@ -2878,7 +3702,7 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
     #
     #     assert roid.shape[0] == wmmask.shape[0]
     #
-    #     pg = nx.read_graphml(parval['node_information_graphml'])
+    #     pg = read_graphml_nodes(parval['node_information_graphml'])
     #
     #     for brk, brv in pg.nodes(data=True):
     #
@@ -2892,13 +3716,13 @@ def create_wm_mask_v2(subject_id, subjects_dir, v=1):
 
     # output white matter mask. crop and move it afterwards
     wm_out = op.join(fs_dir, 'mri', 'fsmask_1mm.nii.gz')
-    img = ni.Nifti1Image(wmmask, fsmask.get_affine(), fsmask.get_header() )
+    img = ni.Nifti1Image(bbox.paste(wmmask), fsmask.get_affine(), fsmask.get_header() )
     if v:
         iflogger.info("    > Save white matter mask: %s" % wm_out)
     ni.save(img, wm_out)
 
     gm_out = op.join(fs_dir, 'mri', 'gmmask.nii.gz')
-    img = ni.Nifti1Image(gmmask, fsmask.get_affine(), fsmask.get_header() )
+    img = ni.Nifti1Image(bbox.paste(gmmask), fsmask.get_affine(), fsmask.get_header() )
     if v:
         iflogger.info("    > Save gray matter mask: %s" % gm_out)
     ni.save(img, gm_out)
@@ -3006,6 +3830,10 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
     niiAPARCimg = ni.load(fout)
     niiAPARCdata = niiAPARCimg.get_data()
 
+    # All the mask arithmetic is done in the bounding box of the labelled voxels and pasted back to the full grid at save time
+    bbox = BoundingBox.from_mask(niiAPARCdata)
+    niiAPARCdata = bbox.crop(niiAPARCdata)
+
     # mri_convert aparc+aseg.mgz aparc+aseg.nii.gz
     WMout = op.join(fs_dir, 'mri', 'fsmask_1mm.nii.gz')
 
@@ -3041,7 +3869,7 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
 
     iflogger.info("WM mask....")
     #%% create WM mask
-    niiWM = np.zeros( niiAPARCdata.shape, dtype = np.uint8 )
+    niiWM = empty_mask( niiAPARCdata.shape )
 
     for i in WM:
         niiWM[niiAPARCdata == i] = 1
@@ -3050,7 +3878,7 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
 #    for i in SUBCORTICAL[1]:
 #         niiWM[niiAPARCdata == i] = 1
 
-    img = ni.Nifti1Image(niiWM, niiAPARCimg.get_affine(), niiAPARCimg.get_header())
+    img = ni.Nifti1Image(bbox.paste(niiWM), niiAPARCimg.get_affine(), niiAPARCimg.get_header())
     iflogger.info("Save to: " + WMout)
     ni.save(img, WMout)
 
@@ -3061,7 +3889,7 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
         iflogger.info("Parcellation: " + park)
         GMout = op.join(fs_dir, 'mri', 'ROIv_%s.nii.gz' % park)
 
-        niiGM = np.zeros( niiAPARCdata.shape, dtype = np.uint8 )
+        niiGM = np.zeros( niiAPARCdata.shape, dtype = label_dtype(len(MAPPING)) )
 
         for ma in MAPPING:
             niiGM[ niiAPARCdata == ma[1]] = ma[0]
@@ -3080,7 +3908,7 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
 #            niiGM[ niiAPARCdata == i ] = OTHER[2][idx]
 
         iflogger.info("Save to: " + GMout)
-        img = ni.Nifti1Image(niiGM, niiAPARCimg.get_affine(), niiAPARCimg.get_header())
+        img = ni.Nifti1Image(bbox.paste(niiGM), niiAPARCimg.get_affine(), niiAPARCimg.get_header())
         ni.save(img, GMout)
 
     # Create CSF mask
@@ -3088,7 +3916,8 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
     subprocess.check_call(mri_cmd)
 
     asegfile = op.join(fs_dir,'mri','aseg.nii.gz')
-    aseg = ni.load( asegfile ).get_data().astype( np.uint32 )
+    bbox = get_brain_bounding_box(fs_dir)
+    aseg = as_labels(bbox.crop(ni.load( asegfile ).get_data()))
     idx = np.where( (aseg == 4) |
                     (aseg == 43) |
                     (aseg == 11) |
@@ -3097,9 +3926,9 @@ def generate_WM_and_GM_mask(subject_id, subjects_dir):
                     (aseg == 63) |
                     (aseg == 10) |
                     (aseg == 49) )
-    er_mask = np.zeros( aseg.shape )
+    er_mask = empty_mask( aseg.shape )
     er_mask[idx] = 1
-    img = ni.Nifti1Image(er_mask, ni.load( asegfile ).get_affine(), ni.load( asegfile ).get_header())
+    img = ni.Nifti1Image(bbox.paste(er_mask), ni.load( asegfile ).get_affine(), ni.load( asegfile ).get_header())
     ni.save(img, op.join(fs_dir, 'mri', 'csf_mask.nii.gz'))
 
     # Convert whole brain mask
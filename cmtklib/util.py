@@ -6,7 +6,32 @@
 """ CMTK Utility functions
 """
 
+import os
+import os.path as op
+import json
+import gzip
+import hashlib
+import shutil
+import tempfile
+import threading
 import numpy as np
+import nibabel as nib
+from scipy import ndimage
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
 class bcolors:
     """ Utility class for color unicode
@@ -137,3 +162,601 @@ def mean_curvature(xyz):
     k = magn(np.cross(dxyz,ddxyz),1)/(magn(dxyz,1)**3)
 
     return np.mean(k)
+
+MASK_DTYPE = np.uint8
+
+def label_dtype(max_label, min_label=0):
+    """ Returns the smallest integer type able to store labels from ``min_label`` to ``max_label`` """
+    for dtype in (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= min_label and max_label <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+def empty_mask(shape):
+    """ Returns a mask of ``shape`` filled with zeros, stored as ``MASK_DTYPE`` """
+    return np.zeros(shape, dtype=MASK_DTYPE)
+
+def as_mask(data):
+    """ Returns the non-zero voxels of ``data`` as a mask stored as ``MASK_DTYPE`` """
+    return (np.asarray(data) != 0).astype(MASK_DTYPE)
+
+def as_labels(data, max_label=0):
+    """ Returns the label volume ``data`` cast to the smallest integer type able to store
+    its labels and any label up to ``max_label`` assigned afterwards """
+    data = np.asarray(data)
+    if data.size == 0:
+        return data.astype(label_dtype(max_label))
+    return data.astype(label_dtype(max(data.max(), max_label), min(data.min(), 0)))
+
+def remove_small_components(labels, min_size=2, structure=None):
+    """ Returns the label volume ``labels`` without the connected components of each label
+    smaller than ``min_size`` voxels (e.g. isolated voxels for ``min_size=2``).
+
+    The components of all labels are found in one ``ndimage.label`` pass: the masks of the
+    labels are stacked along the first axis, separated by a background slab so that
+    components of different labels never touch, and their sizes are counted with
+    ``np.bincount``. ``labels`` should be cropped to the labelled voxels beforehand
+    (see ``BoundingBox``).
+
+    Parameters
+    ----------
+    labels : numpy.ndarray
+        3D label volume (0 is the background)
+
+    min_size : int
+        Minimal number of voxels of the components that are kept
+
+    structure : numpy.ndarray
+        Connectivity of the components (see ``scipy.ndimage.label``)
+    """
+    labels = np.asarray(labels)
+    values = np.unique(labels[labels != 0])
+    filtered = np.zeros_like(labels)
+    if values.size == 0:
+        return filtered
+
+    step = labels.shape[0] + 1
+    stacked = np.zeros((step * values.size,) + labels.shape[1:], dtype=bool)
+    for n, value in enumerate(values):
+        stacked[n * step:n * step + labels.shape[0]] = (labels == value)
+    components, _ = ndimage.label(stacked, structure=structure)
+    del stacked
+
+    sizes = np.bincount(components.ravel())
+    keep = sizes >= min_size
+    keep[0] = False
+    kept = keep[components]
+    del components
+    for n, value in enumerate(values):
+        filtered[kept[n * step:n * step + labels.shape[0]]] = value
+    return filtered
+
+def file_digest(path, block_size=2**20):
+    """ Returns the MD5 digest of the content of the file ``path``.
+
+    Gzipped files (e.g. ``.nii.gz``, ``.mgz``) are digested uncompressed, since their
+    header stores the time of writing.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    with (gzip.open(path, 'rb') if compressed else open(path, 'rb')) as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class OutputStore(object):
+    """ Persistent store of output files, each set of outputs being saved with the
+    manifest (content digests of the inputs and options) that produced it.
+
+    A later run computing the same manifest can restore the stored files instead
+    of recomputing them.
+
+    Parameters
+    ----------
+    directory : str
+        Directory where the outputs and their manifests are kept
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._digests = {}
+
+    def digest(self, path):
+        """ Returns the content digest of ``path`` (computed once per run) """
+        path = op.abspath(path)
+        if path not in self._digests:
+            self._digests[path] = file_digest(path)
+        return self._digests[path]
+
+    def manifest(self, inputs, options):
+        """ Returns the manifest of the input files ``inputs`` (dict name: path) and ``options`` """
+        return {'inputs': dict((name, self.digest(path)) for name, path in inputs.items()),
+                'options': options}
+
+    def _manifest_file(self, name):
+        return op.join(self.directory, '{}_manifest.json'.format(name))
+
+    def restore(self, name, manifest, filenames):
+        """ Copies the stored ``filenames`` to their path if they were produced with ``manifest``.
+
+        Returns True if the outputs were restored, False if they must be recomputed.
+        """
+        manifest_file = self._manifest_file(name)
+        if not op.exists(manifest_file):
+            return False
+        with open(manifest_file, 'r') as f:
+            try:
+                stored = json.load(f)
+            except ValueError:
+                return False
+        if stored != json.loads(json.dumps(manifest)):
+            return False
+        stored_files = [op.join(self.directory, op.basename(filename)) for filename in filenames]
+        if not all(op.exists(stored_file) for stored_file in stored_files):
+            return False
+        for stored_file, filename in zip(stored_files, filenames):
+            shutil.copyfile(stored_file, filename)
+        return True
+
+    def store(self, name, manifest, filenames):
+        """ Copies ``filenames`` to the store with their ``manifest`` """
+        if not op.isdir(self.directory):
+            os.makedirs(self.directory)
+        # The manifest is removed first so that it never describes partially copied outputs
+        manifest_file = self._manifest_file(name)
+        if op.exists(manifest_file):
+            os.remove(manifest_file)
+        for filename in filenames:
+            shutil.copyfile(filename, op.join(self.directory, op.basename(filename)))
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+class GraphMLNodeTable(object):
+    """ Node attributes of a GraphML file stored column-wise.
+
+    Each attribute is a NumPy array with one entry per node, in the order of the
+    nodes in the file. ``nodes()`` iterates over the nodes like ``networkx.Graph.nodes``
+    so that the table can replace a graph read with ``networkx.read_graphml`` when
+    only the node information is needed.
+
+    Parameters
+    ----------
+    ids : numpy.ndarray
+        Node identifiers
+    columns : dict
+        Attribute name: array of the attribute values of the nodes (an array of Python
+        objects if the file gives the attribute with keys of different types, each value
+        having the type of its key as with ``networkx.read_graphml``)
+    missing : dict
+        Attribute name: boolean array of the nodes without a value for the attribute
+        (their entry of the column holds a placeholder). Attributes defined for all
+        nodes can be omitted.
+    """
+
+    def __init__(self, ids, columns, missing=None):
+        self.ids = ids
+        self.columns = columns
+        self.missing = {} if missing is None else missing
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def nodes(self, data=False):
+        """ Returns the node identifiers, or (identifier, attributes) pairs if ``data`` is True """
+        ids = self.ids.tolist()
+        if not data:
+            return ids
+        names = sorted(self.columns.keys())
+        values = zip(*[self.columns[name].tolist() for name in names])
+        missing = dict((name, self.missing[name].tolist()) for name in names if name in self.missing)
+        nodes = []
+        for n, (node_id, row) in enumerate(zip(ids, values)):
+            nodes.append((node_id, dict((name, value) for name, value in zip(names, row)
+                                        if name not in missing or not missing[name][n])))
+        return nodes
+
+_GRAPHML_NS = '{http://graphml.graphdrawing.org/xmlns}'
+_GRAPHML_TYPES = {'boolean': (np.bool_, False),
+                  'int': (np.int64, 0),
+                  'long': (np.int64, 0),
+                  'float': (np.float64, np.nan),
+                  'double': (np.float64, np.nan),
+                  'string': (np.unicode_, u'')}
+
+def _graphml_value(text, attr_type):
+    if attr_type == 'boolean':
+        return text.strip().lower() in ('true', '1')
+    if attr_type in ('int', 'long'):
+        return int(text)
+    if attr_type in ('float', 'double'):
+        return float(text)
+    return text
+
+def _graphml_object(value, attr_type):
+    return u'%s' % value if attr_type == 'string' else value
+
+def _graphml_types(column):
+    # Type of each value of a column of Python objects, stored in the cache files
+    # instead of pickled objects
+    types = []
+    for value in column.tolist():
+        if value is None:
+            types.append('')
+        elif isinstance(value, bool):
+            types.append('boolean')
+        elif isinstance(value, (int, long) if str is bytes else int):
+            types.append('long')
+        elif isinstance(value, float):
+            types.append('double')
+        else:
+            types.append('string')
+    return np.array(types, dtype=np.unicode_)
+
+def _graphml_objects(texts, types):
+    return np.array([_graphml_object(_graphml_value(text, attr_type), attr_type) if attr_type != '' else None
+                     for text, attr_type in zip(texts.tolist(), types.tolist())], dtype=object)
+
+def _parse_graphml_nodes(path):
+    keys = {}
+    ids = []
+    rows = []
+    used_types = {}
+    for _, elem in ElementTree.iterparse(path):
+        tag = elem.tag.replace(_GRAPHML_NS, '')
+        if tag == 'key' and elem.get('for', 'node') in ('node', 'all'):
+            attr_type = elem.get('attr.type', 'string')
+            keys[elem.get('id')] = (elem.get('attr.name', elem.get('id')), attr_type if attr_type in _GRAPHML_TYPES else 'string')
+        elif tag == 'node':
+            row = {}
+            for data in elem.findall(_GRAPHML_NS + 'data'):
+                if data.get('key') in keys:
+                    name, attr_type = keys[data.get('key')]
+                    row[name] = (_graphml_value(data.text or u'', attr_type), attr_type)
+                    used_types.setdefault(name, set()).add(attr_type)
+            ids.append(elem.get('id'))
+            rows.append(row)
+            elem.clear()
+        elif tag in ('edge', 'hyperedge'):
+            elem.clear()
+
+    # Several keys can declare the same attribute name with different types (e.g.
+    # dn_correspondence_id in the Lausanne2008 resolution83 and resolution1015 files).
+    # As networkx.read_graphml, each value keeps the type of the key it is given with,
+    # so the column of an attribute given with keys of different types stores Python objects
+    columns = {}
+    missing = {}
+    for name in set(name for name, _ in keys.values()):
+        types = used_types.get(name, set(attr_type for key_name, attr_type in keys.values() if key_name == name))
+        if len(types) > 1:
+            values = np.array([_graphml_object(*row[name]) if name in row else None for row in rows], dtype=object)
+        else:
+            dtype, fill = _GRAPHML_TYPES[list(types)[0]]
+            values = np.array([row[name][0] if name in row else fill for row in rows], dtype=dtype)
+        columns[name] = values
+        is_missing = np.array([name not in row for row in rows], dtype=bool)
+        if is_missing.any():
+            missing[name] = is_missing
+    return GraphMLNodeTable(np.array(ids, dtype=np.unicode_), columns, missing)
+
+GRAPHML_CACHE_DIR = os.environ.get('CMTKLIB_GRAPHML_CACHE', op.join(tempfile.gettempdir(), 'cmtklib_graphml_cache'))
+
+_graphml_tables = {}
+
+# Version of the layout of the cache files, part of their key
+_GRAPHML_CACHE_FORMAT = 2
+
+def read_graphml_nodes(path, cache_dir=None):
+    """ Returns the node attributes of the GraphML file ``path`` as a ``GraphMLNodeTable``.
+
+    The table is parsed once and kept in memory and in a binary ``.npz`` file of
+    ``cache_dir`` (``GRAPHML_CACHE_DIR`` by default), both keyed by the path and the
+    modification time of the file. Other processes, e.g. subjects processed
+    concurrently, load the binary file instead of parsing the XML again.
+    """
+    path = op.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key in _graphml_tables:
+        return _graphml_tables[key]
+
+    cache_dir = GRAPHML_CACHE_DIR if cache_dir is None else cache_dir
+    cache_file = op.join(cache_dir, '{}.npz'.format(hashlib.md5(repr((_GRAPHML_CACHE_FORMAT,) + key).encode('utf-8')).hexdigest()))
+    table = None
+    if op.exists(cache_file):
+        try:
+            with np.load(cache_file) as npz:
+                columns = dict((name[len('col_'):], npz[name]) for name in npz.files if name.startswith('col_'))
+                for name in npz.files:
+                    if name.startswith('types_'):
+                        columns[name[len('types_'):]] = _graphml_objects(npz['col_' + name[len('types_'):]], npz[name])
+                missing = dict((name[len('missing_'):], npz[name]) for name in npz.files if name.startswith('missing_'))
+                table = GraphMLNodeTable(npz['ids'], columns, missing)
+        except (IOError, ValueError, KeyError):
+            table = None
+
+    if table is None:
+        table = _parse_graphml_nodes(path)
+        # The cache file is written under a temporary name and renamed, so that
+        # concurrent readers never see a partially written file
+        tmp_file = None
+        try:
+            if not op.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_file = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                arrays = {}
+                for name, column in table.columns.items():
+                    if column.dtype == object:
+                        arrays['col_' + name] = np.array([u'' if value is None else u'%s' % value for value in column.tolist()], dtype=np.unicode_)
+                        arrays['types_' + name] = _graphml_types(column)
+                    else:
+                        arrays['col_' + name] = column
+                arrays.update(('missing_' + name, is_missing) for name, is_missing in table.missing.items())
+                np.savez(f, ids=table.ids, **arrays)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            if tmp_file is not None and op.exists(tmp_file):
+                os.remove(tmp_file)
+
+    _graphml_tables[key] = table
+    return table
+
+class VolumeCache(object):
+    """ In-memory cache of the volumes loaded by one interface run.
+
+    Images are loaded once per path and their data arrays are kept per requested
+    dtype, so that a NIfTI file shared by several processing steps is only read
+    (and decompressed) once. Arrays are shared between callers and must not be
+    modified in place.
+    """
+
+    def __init__(self):
+        self._images = {}
+        self._data = {}
+        self._derived = {}
+
+    def _key(self, path):
+        if not isinstance(path, string_types):
+            raise TypeError("Invalid volume path: {}".format(path))
+        return op.abspath(path)
+
+    def load(self, path):
+        """ Returns the nibabel image of ``path`` """
+        key = self._key(path)
+        if key not in self._images:
+            self._images[key] = nib.load(key)
+        return self._images[key]
+
+    def get_data(self, path, dtype=None):
+        """ Returns the data array of ``path``, cast to ``dtype`` if given """
+        key = self._key(path)
+        dkey = (key, None if dtype is None else np.dtype(dtype).str)
+        if dkey not in self._data:
+            if dtype is None:
+                self._data[dkey] = self.load(path).get_data()
+            else:
+                self._data[dkey] = np.asarray(self.get_data(path), dtype=dtype)
+        return self._data[dkey]
+
+    def derived(self, key, compute):
+        """ Returns the result of ``compute()`` stored under ``key``, computing it on first access """
+        if key not in self._derived:
+            self._derived[key] = compute()
+        return self._derived[key]
+
+    def share(self, directory):
+        """ Moves the derived arrays of the cache to read-only memory-mapped files in ``directory``.
+
+        Worker processes forked afterwards read the arrays from the page cache instead
+        of each holding its own copy.
+        """
+        for n, (key, value) in enumerate(list(self._derived.items())):
+            if isinstance(value, np.ndarray) and not isinstance(value, np.memmap):
+                filename = op.join(directory, 'derived_{}.npy'.format(n))
+                np.save(filename, value)
+                self._derived[key] = np.load(filename, mmap_mode='r')
+
+    def unshare(self):
+        """ Drops the memory-mapped arrays of the cache (they are computed again if needed) """
+        for key in [k for k, v in self._derived.items() if isinstance(v, np.memmap)]:
+            del self._derived[key]
+
+    def release(self, path):
+        """ Drops the image, arrays and derived results cached for ``path`` """
+        key = self._key(path)
+        self._images.pop(key, None)
+        for dkey in [k for k in self._data if k[0] == key]:
+            del self._data[dkey]
+        for dkey in [k for k in self._derived if isinstance(k, tuple) and k and k[0] == key]:
+            del self._derived[dkey]
+
+class AsyncImageWriter(object):
+    """ Write-behind saver of images: ``save`` returns as soon as the image is queued
+    and a small pool of threads compresses and writes it in the background.
+
+    The queue is bounded so that at most ``max_pending`` images wait in memory.
+    ``flush`` (or ``close``) must be called before the files are used; it raises
+    the first error met while writing. The writer can be used as a context manager.
+    Threads are not inherited by forked processes, so each process needs its own writer.
+
+    Parameters
+    ----------
+    number_of_threads : int
+        Number of threads writing the images
+
+    max_pending : int
+        Maximal number of queued images
+    """
+
+    def __init__(self, number_of_threads=2, max_pending=2):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._threads = []
+        for _ in range(max(1, number_of_threads)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                img, filename = item
+                try:
+                    nib.save(img, filename)
+                except Exception as e:
+                    self._errors.append((filename, e))
+            finally:
+                self._queue.task_done()
+
+    def save(self, img, filename):
+        """ Queues ``img`` to be saved to ``filename``. The data of the image must not be modified afterwards. """
+        if len(self._threads) == 0:
+            raise RuntimeError('Cannot save {}: the image writer is closed'.format(filename))
+        self._queue.put((img, filename))
+
+    def flush(self):
+        """ Waits until all queued images are written """
+        self._queue.join()
+        if len(self._errors) > 0:
+            filename, e = self._errors[0]
+            del self._errors[:]
+            raise IOError('Failed to save {}: {}'.format(filename, e))
+
+    def close(self):
+        """ Flushes the queue and stops the threads """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not hide the original error behind a writing error
+            try:
+                self.close()
+            except IOError:
+                pass
+        return False
+
+class BoundingBox(object):
+    """ Box of a 3D voxel grid, used to run voxel-wise processing on a cropped view
+    of the volumes and to paste the results back into the full grid at save time.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the full 3D grid
+
+    lower : array-like
+        First voxel index of the box along each axis
+
+    upper : array-like
+        Last voxel index (excluded) of the box along each axis
+    """
+
+    def __init__(self, shape, lower, upper):
+        self.shape = tuple(int(s) for s in shape[:3])
+        self.lower = np.maximum(np.asarray(lower, dtype=int), 0)
+        self.upper = np.minimum(np.asarray(upper, dtype=int), self.shape)
+        self.upper = np.maximum(self.upper, self.lower)
+
+    @classmethod
+    def from_mask(cls, mask, margin=0):
+        """ Returns the box of the non-zero voxels of ``mask`` (first three axes), padded by ``margin`` voxels """
+        mask = np.asarray(mask)
+        if mask.ndim > 3:
+            mask = mask.reshape(mask.shape[:3] + (-1,)).any(axis=3)
+        lower = []
+        upper = []
+        for axis in range(3):
+            other = tuple(a for a in range(3) if a != axis)
+            ind = np.flatnonzero(mask.any(axis=other))
+            if ind.size == 0:
+                return cls(mask.shape, (0, 0, 0), (0, 0, 0))
+            lower.append(ind[0] - margin)
+            upper.append(ind[-1] + 1 + margin)
+        return cls(mask.shape, lower, upper)
+
+    @classmethod
+    def from_indices(cls, shape, indices, margin=0):
+        """ Returns the box of the voxels given by ``indices`` (as returned by ``np.where``) """
+        if len(indices) == 0 or np.asarray(indices[0]).size == 0:
+            return cls(shape, (0, 0, 0), (0, 0, 0))
+        lower = [np.min(ind) - margin for ind in indices[:3]]
+        upper = [np.max(ind) + 1 + margin for ind in indices[:3]]
+        return cls(shape, lower, upper)
+
+    @classmethod
+    def full(cls, shape):
+        """ Returns the box covering the full grid """
+        return cls(shape, (0, 0, 0), shape[:3])
+
+    @property
+    def slices(self):
+        return tuple(slice(l, u) for l, u in zip(self.lower, self.upper))
+
+    @property
+    def cropped_shape(self):
+        return tuple(int(u - l) for l, u in zip(self.lower, self.upper))
+
+    def is_empty(self):
+        return any(u <= l for l, u in zip(self.lower, self.upper))
+
+    def union(self, other):
+        """ Returns the smallest box containing this box and ``other`` """
+        if self.is_empty():
+            return other
+        if other.is_empty():
+            return self
+        return BoundingBox(self.shape, np.minimum(self.lower, other.lower), np.maximum(self.upper, other.upper))
+
+    def crop(self, data):
+        """ Returns the view of ``data`` in the box (extra axes, e.g. 4D volumes, are kept) """
+        return data[self.slices]
+
+    def relative_to(self, other):
+        """ Returns this box in the voxel grid of the box ``other``, which must contain it """
+        return BoundingBox(other.cropped_shape, self.lower - other.lower, self.upper - other.lower)
+
+    def crop_affine(self, affine):
+        """ Returns the voxel-to-world ``affine`` of the full grid translated to the box """
+        translation = np.eye(4)
+        translation[:3, 3] = self.lower
+        return np.dot(affine, translation)
+
+    def paste_affine(self, affine):
+        """ Returns the voxel-to-world ``affine`` of the box translated back to the full grid """
+        translation = np.eye(4)
+        translation[:3, 3] = -self.lower
+        return np.dot(affine, translation)
+
+    def crop_indices(self, indices):
+        """ Converts indices of the full grid (as returned by ``np.where``) to indices in the box """
+        return tuple(np.asarray(ind) - l for ind, l in zip(indices, self.lower))
+
+    def paste(self, data, dtype=None, fill=0):
+        """ Returns a full-grid array filled with ``fill`` outside the box and ``data`` inside """
+        data = np.asarray(data)
+        full = np.empty(self.shape + data.shape[3:], dtype=data.dtype if dtype is None else dtype)
+        full.fill(fill)
+        full[self.slices] = data
+        return full